@@ -0,0 +1,65 @@
+import time
+import torch
+import torch.nn.functional as F
+from argparse import ArgumentParser
+from models.Hyperfusion.HyperFusion_brainage_model import *
+from models.Film_DAFT_preactive.models_film_daft import *
+from models.base_models import *
+from models.concat_models import *
+
+
+def saved_activations_bytes(model, x):
+    # the memory autograd keeps for the backward of one training step (the bulk of the training memory)
+    saved = {}
+
+    def pack(tensor):
+        saved[(tensor.data_ptr(), tensor.dtype)] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        model(x).float().sum().backward()
+    model.zero_grad(set_to_none=True)
+    return sum(saved.values())
+
+
+def benchmark(model, x, precision, steps=5):
+    # training steps per second (forward + backward) and the activations memory of one step
+    device_type = x[0].device.type
+    autocast = torch.autocast(device_type=device_type, dtype=torch.bfloat16, enabled=(precision == "bf16"))
+    model.train()
+    with autocast:
+        activations = saved_activations_bytes(model, x)
+        model(x).float().sum().backward()  # warmup
+        if device_type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(steps):
+            model(x).float().sum().backward()
+        if device_type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+    model.zero_grad(set_to_none=True)
+    return dict(samples_per_sec=steps * len(x[0]) / elapsed, activations_MB=activations / 2 ** 20)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="training throughput and memory of fp32 vs bf16 autocast")
+    parser.add_argument('--model_name', type=str, default="HyperFusion_Brainage")
+    parser.add_argument('--image_shape', type=int, nargs=3, default=[84, 92, 116], help="D H W of the input scans")
+    parser.add_argument('--tabular_size', type=int, default=2)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--device', type=str, default="cpu")
+    args = parser.parse_args()
+
+    model = globals()[args.model_name](train_loader=None, GPU=None, n_tabular_features=args.tabular_size).to(args.device)
+    image = torch.randn(args.batch_size, 1, *args.image_shape, device=args.device)
+    # one hot conditioning, as the sex of the brain age models
+    tabular = F.one_hot(torch.arange(args.batch_size) % args.tabular_size, args.tabular_size).float().to(args.device)
+
+    results = {precision: benchmark(model, (image, tabular), precision, args.steps) for precision in ("32", "bf16")}
+    for precision, result in results.items():
+        print(f"precision {precision}: {result['samples_per_sec']:.2f} samples/sec, "
+              f"{result['activations_MB']:.1f} MB saved activations per step")
+    print(f"bf16 speedup: {results['bf16']['samples_per_sec'] / results['32']['samples_per_sec']:.2f}x, "
+          f"memory ratio: {results['bf16']['activations_MB'] / results['32']['activations_MB']:.2f}")
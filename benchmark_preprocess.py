@@ -0,0 +1,86 @@
+import time
+import numpy as np
+import pandas as pd
+from argparse import ArgumentParser
+from data_utils.MetadataPreprocess import MetadataPreprocessor, DEFAULT_CSV_PATH
+
+
+# the former row wise implementations of the vectorized operations - the reference for the outputs and the timing
+def legacy_gauss_1d(n=10, sigma=1, mu=None):
+    if mu is None:
+        mu = n//2
+    r = range(n)
+    gaussian = np.array([1 / (sigma * np.sqrt(2*np.pi)) * np.exp(-float(x - mu)**2/(2*sigma**2)) for x in r])
+    gaussian[gaussian < 1e-8] = 0
+    gaussian /= gaussian.sum()  # normalize to sum to 1
+    return gaussian
+
+
+def legacy_remove_gt_lt(csv, col_name):
+    for i in range(len(csv[col_name])):
+        if csv[col_name][i] is not np.nan:
+            if (csv[col_name][i][0] == '<') or (csv[col_name][i][0] == '>'):
+                csv.loc[i, col_name] = csv[col_name][i][1:]
+        if csv[col_name][i] is not np.nan:
+            csv.loc[i, col_name] = float(csv[col_name][i])
+    return csv
+
+
+def legacy_age_smoothed_one_hot(csv, col_name):
+    n = int(csv["AGE"].max() - csv["AGE"].min()) + 1
+    smoothed_ages = []
+    for age in csv["AGE"]:
+        smoothed_ages.append(legacy_gauss_1d(n=n, sigma=1, mu=age - csv["AGE"].min()))
+    cols = ["AGE_{}".format(i + int(csv["AGE"].min())) for i in range(n)]
+    csv[cols] = smoothed_ages
+    csv.drop('AGE', inplace=True, axis=1)
+    return csv
+
+
+def legacy_median_by_label(csv, col_name):
+    for label in csv["Group"].unique():
+        labels_median = csv[col_name][csv["Group"] == label].median()
+        csv[col_name][csv[col_name].isna() & (csv["Group"] == label)] = labels_median
+    return csv
+
+
+# operation: (its former implementation, the columns of the csv to run it on)
+BENCHMARKS = {
+    "remove><": (legacy_remove_gt_lt, ["ABETA", "PTAU", "TAU"]),
+    "AGE_smoothed_one_hot": (legacy_age_smoothed_one_hot, ["AGE"]),
+    "fill NaN with median w.r.t labels": (legacy_median_by_label, ["FDG", "AV45", "PTEDUCAT"]),
+}
+
+
+def identical(df1, df2):
+    # same columns, dtypes and values (NaNs included), and the same row hashes
+    return list(df1.columns) == list(df2.columns) and (df1.dtypes == df2.dtypes).all() and df1.equals(df2) and \
+        pd.util.hash_pandas_object(df1).equals(pd.util.hash_pandas_object(df2))
+
+
+def timeit(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="the vectorized preprocessing operations vs their former row wise versions")
+    parser.add_argument('--csv_path', type=str, default=DEFAULT_CSV_PATH)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    adni_csv = pd.read_csv(args.csv_path)
+    pd.options.mode.chained_assignment = None  # the legacy implementations assign through chained indexing
+    for operation, (legacy_fn, columns) in BENCHMARKS.items():
+        for col_name in columns:
+            csv = adni_csv.loc[:, [col_name, "Subject", "Group"]]
+            preprocessor = MetadataPreprocessor({col_name: [operation]})
+            legacy_out, legacy_time = timeit(lambda: legacy_fn(csv.copy(), col_name), args.repeats)
+            out, new_time = timeit(lambda: preprocessor.apply_operation(csv.copy(), col_name, operation, (col_name, 0),
+                                                                        fit=True), args.repeats)
+            print(f"{operation:<35} {col_name:<9} legacy {legacy_time * 1e3:9.2f} ms   vectorized {new_time * 1e3:7.2f} ms"
+                  f"   speedup {legacy_time / new_time:7.1f}x   identical: {identical(out, legacy_out)}")
@@ -0,0 +1 @@
+# the tests import the repo modules (data_utils, models, utils) from the repo root
@@ -4,6 +4,11 @@ import cv2
 import nibabel as nib
 from .MetadataPreprocess import *
 import pytorch_lightning as pl
+import monai
+from .transformation import tform_dict
+from utils.cache_utils import cache_path, hash_key, load_json, save_json
+from .volume_cache import VolumeCache, load_scan, preprocess_scan, split_deterministic_prefix, quantize_volume, \
+    dequantize_volume
 
 
 class ADNIDataModule(pl.LightningDataModule):
@@ -17,12 +22,19 @@ class ADNIDataModule(pl.LightningDataModule):
         self.batch_size = config.batch_size
         self.num_workers = config.num_workers
 
+        # the preprocessed metadata is computed (or read from its cache) once and shared by the splits. the fitted
+        # preprocessor is kept to preprocess new patients the same way
+        dataset_cfg = config.dataset_cfg
+        self.metadata_preprocessor, metadata = fit_metadata_preprocessor(
+            features_set_idx=dataset_cfg.get("features_set", 5), split_seed=dataset_cfg.get("split_seed", 0),
+            fold=dataset_cfg.get("fold", 0))
+
         self.train_ds = self.valid_ds = self.test_ds = None
         if stage == "train":
             self.train_ds = ADNI_Dataset(tr_val_tst="train", transform=transform_train,
-                                         l2r_tform=l2r_tform_train, **config.dataset_cfg)
+                                         l2r_tform=l2r_tform_train, metadata=metadata, **config.dataset_cfg)
             self.valid_ds = ADNI_Dataset(tr_val_tst="valid", transform=transform_valid,
-                                         l2r_tform=l2r_tform_valid, **config.dataset_cfg)
+                                         l2r_tform=l2r_tform_valid, metadata=metadata, **config.dataset_cfg)
 
             if 1 > config.sample > 0:  # take a portion of the data (for debuggind the model)
                 num_train_samples = int(len(self.train_ds) * config.sample)
@@ -33,7 +45,7 @@ class ADNIDataModule(pl.LightningDataModule):
 
         elif stage == "test":
             self.test_ds = ADNI_Dataset(tr_val_tst="test", transform=transform_valid,
-                                         l2r_tform=l2r_tform_valid, **config.dataset_cfg)
+                                         l2r_tform=l2r_tform_valid, metadata=metadata, **config.dataset_cfg)
 
 
     def train_dataloader(self):
@@ -49,15 +61,40 @@ class ADNIDataModule(pl.LightningDataModule):
         return DataLoader(dataset=self.test_ds, batch_size=self.batch_size, num_workers=self.num_workers)
 
 
+def stratified_folds(metadata, labels_dict, split_seed=0, n_folds=5, age_bins=20):
+    """ the rows of the metadata in the order they are dealt to the folds, and their folds: the rows are shuffled
+    by the seed, grouped by sex (if it is a feature, in order of appearance), label (in order of appearance) and
+    age bin, and dealt round robin. rows missing one of them are left out of the folds (so they are in train) """
+    df = metadata.sample(frac=1, random_state=split_seed)
+    age = pd.cut(df["AGE"], bins=age_bins, labels=False).to_numpy()
+    keys = [pd.factorize(df["Group"].replace(labels_dict))[0]]
+    if "PTGENDER_Male" in df.columns:  # if sex is a feature
+        keys.insert(0, pd.factorize(df["PTGENDER_Male"])[0])
+    has_keys = ~np.isnan(age) & np.all([key >= 0 for key in keys], axis=0)
+
+    position = np.arange(len(df))
+    order = np.lexsort([position[has_keys], age[has_keys]] + [key[has_keys] for key in keys[::-1]])
+    rows = df.index.to_numpy()[has_keys][order]
+    return rows, np.arange(len(rows)) % n_folds
+
+
 class ADNI_Dataset(Dataset):
     def __init__(self, tr_val_tst, fold=0, features_set=5,
                  adni_dir='/home/duenias/PycharmProjects/HyperNetworks/ADNI_2023/ADNI',
                  transform=None, load2ram=False, rand_seed=2341, with_skull=False,
                  no_bias_field_correct=False, only_tabular=False, num_classes=3, split_seed=0,
-                 l2r_tform=None, ADvsCN=False):
+                 l2r_tform=None, ADvsCN=False, volume_cache=True, storage_dtype="float32", metadata=None):
         self.tr_val_tst = tr_val_tst
-        self.transform = tform_dict[transform]
-        self.metadata = create_metadata_csv(features_set_idx=features_set, split_seed=split_seed, fold=fold)
+        self.features_set = features_set
+        # the scans after the deterministic prefix of the transform (mask, crop...) are cached on disk, and kept
+        # in ram (load2ram), in the storage dtype (float32, float16 or uint8/uint16 with a per volume scale and offset)
+        self.storage_dtype = storage_dtype
+        self.volume_cache = VolumeCache(adni_dir, with_skull, no_bias_field_correct,
+                                        storage_dtype) if volume_cache else None
+        self.set_transform(tform_dict[transform])
+        if metadata is None:
+            metadata = create_metadata_csv(features_set_idx=features_set, split_seed=split_seed, fold=fold)
+        self.metadata = metadata.copy()
         self.labels_dict = {
             2: {"CN": 0, 'AD': 1},
             3: {"CN": 0, 'MCI': 1, "AD": 2, 'EMCI': 1, "LMCI": 1},
@@ -83,58 +120,64 @@ class ADNI_Dataset(Dataset):
 
         self.metadata.reset_index(drop=True, inplace=True)
 
+        # the features, labels and subjects as arrays - the items are served by indexing, without pandas
+        self.features = np.ascontiguousarray(self.metadata.drop(['Subject', 'Group'], axis=1), dtype=np.float32)
+        self.labels = self.metadata["Group"].map(self.labels_dict).to_numpy(dtype=np.int64)
+        self.subjects = self.metadata["Subject"].to_numpy()
+
+        # identifies the content of the dataset for caching statistics computed over it (e.g. for initializations)
+        self.stats_key = f"ADNI-{tr_val_tst}-fs{features_set}-seed{split_seed}-fold{fold}-{num_classes}cls-" \
+                         f"{transform}-{l2r_tform if load2ram else None}-skull{with_skull}-nbfc{no_bias_field_correct}-" \
+                         f"{pd.util.hash_pandas_object(self.metadata).sum()}"
+
         self.data_in_ram = False
-        self.imgs_ram_lst = []
+        self.imgs_ram = None
+        self.ram_dtype = None  # the numpy dtype of the scans in ram when the tensor holds them as another dtype
         if load2ram:
             self.load_data2ram(l2r_tform)
             self.data_in_ram = True
 
     def get_folds_split(self, fold, split_seed=0):
         # ----------- split w.r.t the joint distribution of the label, sex & age -----------------
-        df = self.metadata.copy()
-        df = df.sample(frac=1, random_state=split_seed)
-        df = df.replace(self.labels_dict)
-        bins = 20
-        df["AGE"] = pd.cut(df["AGE"], bins=bins, labels=[i for i in range(bins)])
-        folds = [[], [], [], [], []]
-        folds_idx = 0
-
-        if "PTGENDER_Male" in df.columns:  # if sex is a feature
-            for sex in df["PTGENDER_Male"].unique():
-                for label in df["Group"].unique():
-                    for age in np.sort(df["AGE"].unique()):
-                        sub_df = df[(df["PTGENDER_Male"] == sex) & (df["Group"] == label) & (df["AGE"] == age)]
-                        for idx in sub_df.index:
-                            folds[folds_idx].append(idx)
-                            folds_idx = (folds_idx + 1) % 5
-
-        else:   # if there is AGE without sex
-            for label in df["Group"].unique():
-                for age in np.sort(df["AGE"].unique()):
-                    sub_df = df[(df["Group"] == label) & (df["AGE"] == age)]
-                    for idx in sub_df.index:
-                        folds[folds_idx].append(idx)
-                        folds_idx = (folds_idx + 1) % 5
-
-
-        val_idxs = folds[fold]
-        test_idxs = folds[4]
+        # the folds manifest is shared by all the runs (and the train/valid/test datasets) of the same split
+        split_cols = [col for col in ["Subject", "Group", "PTGENDER_Male", "AGE"] if col in self.metadata.columns]
+        manifest_path = cache_path("folds", f"fs{self.features_set}-seed{split_seed}-{self.num_classes}cls-"
+                                            f"{hash_key(pd.util.hash_pandas_object(self.metadata[split_cols]).sum())}.json")
+        manifest = load_json(manifest_path)
+        if manifest is None:
+            rows, folds = stratified_folds(self.metadata, self.labels_dict, split_seed)
+            manifest = {"rows": rows.tolist(), "subjects": self.metadata.loc[rows, "Subject"].tolist(),
+                        "folds": folds.tolist()}
+            save_json(manifest_path, manifest)
+        rows, folds = np.array(manifest["rows"], dtype=np.int64), np.array(manifest["folds"], dtype=np.int64)
+
+        val_idxs = list(rows[folds == fold])
+        test_idxs = list(rows[folds == 4])
 
         train_idxs = list(np.where(~self.metadata.index.isin(list(val_idxs) + list(test_idxs)))[0])
         np.random.shuffle(train_idxs)
         idxs_dict = {'valid': val_idxs, 'train': train_idxs, 'test': test_idxs}
         return idxs_dict
 
+    def set_transform(self, tform):
+        # the deterministic prefix of the transform (prefix_tforms) runs once per scan - its output is what the
+        # volume cache and the ram store keep - and only the rest (the normalization and the random augmentations)
+        # runs on every __getitem__
+        self.prefix_tforms, rest = split_deterministic_prefix(tform)
+        self.transform = monai.transforms.Compose(rest) if rest else None
+
     def load_image(self, subject):
-        if self.no_bias_field_correct:
-            img_path = os.path.join(self.adni_dir, subject, "brain_scan_simple.nii.gz")
-        else:
-            img_path = os.path.join(self.adni_dir, subject, "brain_scan.nii.gz")
-        img = nib.load(img_path).get_fdata()
-        if not self.with_skull:
-            mask_path = os.path.join(self.adni_dir, subject, "brain_mask.nii.gz")
-            img = img * nib.load(mask_path).get_fdata()  # apply the brain mask
-        return img
+        return load_scan(self.adni_dir, subject, self.with_skull, self.no_bias_field_correct)
+
+    def load_stored_volume(self, subject):
+        # (stored, scale, offset) of the scan with a channel dimension, after the prefix transforms
+        if self.volume_cache is not None:
+            return self.volume_cache.load_stored(subject, self.prefix_tforms)
+        img = preprocess_scan(self.adni_dir, subject, self.prefix_tforms, self.with_skull, self.no_bias_field_correct)
+        return quantize_volume(img, self.storage_dtype)
+
+    def load_volume(self, subject):
+        return dequantize_volume(*self.load_stored_volume(subject))
 
     def load_image_npy(self, subject):
         if self.no_bias_field_correct:
@@ -149,48 +192,57 @@ class ADNI_Dataset(Dataset):
 
     def load_data2ram(self, l2r_tform):
         assert l2r_tform is not None, "Used load to ram flag without specifying the relevant l2r_tform!"
-        save_tform = self.transform  # save the regolar tform in this temp variable
-        self.transform = tform_dict[l2r_tform]
-        if self.tr_val_tst in ["valid", "test"]:
-            loader = DataLoader(dataset=self, batch_size=1, shuffle=False, num_workers=5)
-            for batch in tqdm(loader, f'Loading {self.tr_val_tst} data to ram: '):
-                self.imgs_ram_lst.append((batch[0][0].type(torch.float32), batch[1][0], batch[2][0]))
-
-        if self.tr_val_tst == "train":
-            loader = DataLoader(dataset=self, batch_size=1, shuffle=False, num_workers=20)
-            for img, _, _ in tqdm(loader, f'Loading {self.tr_val_tst} data to ram: '):
-                self.imgs_ram_lst.append(np.array(img[0, 0]))
-
-        self.transform = save_tform
+        save_tform = (self.prefix_tforms, self.transform)  # save the regolar tform in this temp variable
+        self.set_transform(tform_dict[l2r_tform])
+        num_workers = 20 if self.tr_val_tst == "train" else 5
+        loader = DataLoader(dataset=list(self.subjects), batch_size=None, shuffle=False,
+                            num_workers=num_workers, collate_fn=self.load_stored_volume)
+        self.ram_qparams = torch.empty((len(self), 2), dtype=torch.float64)
+        for i, (stored, scale, offset) in enumerate(tqdm(loader, f'Loading {self.tr_val_tst} data to ram: ')):
+            if stored.dtype == np.uint16:
+                # torch < 2.3 has no uint16 tensors - the bits are kept as int16 and viewed back in __getitem__
+                self.ram_dtype = stored.dtype
+                stored = stored.view(np.int16)
+            if i == 0:
+                # all the scans in one contiguous tensor in shared memory - the dataloader workers read it in
+                # place, instead of copying the pages of a list of arrays as they touch their refcounts
+                self.imgs_ram = torch.empty((len(self),) + stored.shape, dtype=torch.from_numpy(stored).dtype)
+                self.imgs_ram.share_memory_()
+            self.imgs_ram[i] = torch.from_numpy(stored)
+            self.ram_qparams[i] = torch.tensor([scale, offset])
+
+        # the rest of the l2r transform and the regular transform run on the scans in ram on every __getitem__
+        l2r_rest = self.transform
+        tforms = [t for t in [l2r_rest] + save_tform[0] + [save_tform[1]] if t is not None]
+        self.prefix_tforms, self.transform = [], monai.transforms.Compose(tforms) if tforms else None
 
     def __len__(self):
         return len(self.metadata)
 
     def __getitem__(self, index):
-        if self.data_in_ram:  # the data is a list alredy
-            if self.tr_val_tst in ["valid", "test"]:
-                img, features, label = self.imgs_ram_lst[index]
-                return img.type(torch.float32), features, label
-            if self.tr_val_tst == "train":
-                img = self.imgs_ram_lst[index].copy()
+        if self.data_in_ram:  # the data is a tensor alredy
+            scale, offset = self.ram_qparams[index].tolist()
+            stored = self.imgs_ram[index, 0].numpy()
+            if self.ram_dtype is not None:
+                stored = stored.view(self.ram_dtype)
+            img = dequantize_volume(stored, scale, offset)  # a float32 copy
 
         else:  # we need to load the data from the data dir
-            subject = self.metadata.loc[index, "Subject"]
+            subject = self.subjects[index]
             if self.only_tabular:
                 img = np.zeros((4, 4, 4, 4))
             else:
-                img = self.load_image(subject)
+                img = self.load_volume(subject)[0]
 
-        features = self.metadata.drop(['Subject', 'Group'], axis=1).loc[index]
-        label = self.metadata.loc[index, "Group"]
+        features, label = self.features[index], self.labels[index]
         if self.only_tabular:
-            return img, np.array(features, dtype=np.float32), self.labels_dict[label]
+            return img, features, label
 
         img = img[None, ...]  # add channel dimention
         if not (self.transform is None):
             img = self.transform(img)
 
-        return img, np.array(features, dtype=np.float32), self.labels_dict[label]
+        return img, features, label
 
 
 def imshow(img):
@@ -5,6 +5,7 @@ import numpy as np
 from tqdm import tqdm
 import shutil
 import pytorch_lightning as pl
+from utils.cache_utils import cache_path, hash_key, atomic_write, file_lock
 
 
 class BrainAgeDataModule(pl.LightningDataModule):
@@ -34,9 +35,63 @@ class BrainAgeDataModule(pl.LightningDataModule):
         return DataLoader(dataset=self.test_ds, batch_size=self.batch_size, num_workers=self.num_workers)
 
 
+class VolumeStore:
+    """ the volumes of a data dir consolidated into one (N, D, H, W) volumes.npy, read through a memory map, and an
+    index table (index.csv) of the subject of each row """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        index = pd.read_csv(os.path.join(store_dir, "index.csv"))
+        self.row_of = pd.Series(index["row"].to_numpy(), index=index["Subject"])
+        self._volumes = None
+
+    @property
+    def volumes(self):
+        # opened lazily - in each dataloader worker - as a copy on write memory map, so the slices are writable
+        if self._volumes is None:
+            self._volumes = np.load(os.path.join(self.store_dir, "volumes.npy"), mmap_mode="c")
+        return self._volumes
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_volumes"] = None  # the memory map is never pickled (e.g. to spawned workers)
+        return state
+
+    def rows(self, subjects):
+        return self.row_of.loc[subjects].to_numpy()
+
+    @staticmethod
+    def default_dir(data_dir, subjects):
+        return os.path.dirname(cache_path("brainage_store", hash_key(os.path.abspath(data_dir), list(subjects)), "index.csv"))
+
+    @staticmethod
+    def build(data_dir, subjects, store_dir=None):
+        """ the store of the {subject}.npy files of data_dir - built once (under a lock, so concurrent jobs wait
+        for one build) and opened afterwards """
+        subjects = list(subjects)
+        store_dir = store_dir or VolumeStore.default_dir(data_dir, subjects)
+        volumes_path, index_path = os.path.join(store_dir, "volumes.npy"), os.path.join(store_dir, "index.csv")
+        with file_lock(volumes_path):
+            if not os.path.exists(index_path):
+                first = np.load(os.path.join(data_dir, f"{subjects[0]}.npy"))
+
+                def write_volumes(tmp_path):
+                    volumes = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=first.dtype,
+                                                        shape=(len(subjects),) + first.shape)
+                    for row, subject in enumerate(tqdm(subjects, "building the volume store")):
+                        img = np.load(os.path.join(data_dir, f"{subject}.npy"))
+                        assert img.shape == first.shape, f"{subject} is of shape {img.shape}, not {first.shape}"
+                        volumes[row] = img
+                    volumes.flush()
+
+                atomic_write(volumes_path, write_volumes)
+                index = pd.DataFrame({"Subject": subjects, "row": np.arange(len(subjects))})
+                atomic_write(index_path, lambda tmp_path: index.to_csv(tmp_path, index=False))  # marks a complete store
+        return VolumeStore(store_dir)
+
+
 class BrainAge_Dataset(Dataset):
     def __init__(self, data_dir, metadata_dir, gender=None, data_type=None,
-                 transform=None, partial_data=False, ages=None):
+                 transform=None, partial_data=False, ages=None, volume_store=False, store_dir=None):
 
         if data_type is None:
             metadata_path = os.path.join(metadata_dir, "metadata_age_prediction.csv")
@@ -58,18 +113,35 @@ class BrainAge_Dataset(Dataset):
         self.transform = transform
         self.only_tabular = False
 
+        # the conditioning (one hot sex), the ages and the subjects as arrays - the items are served by indexing
+        self.genders = np.ascontiguousarray(self.metadata[["Gender_F", "Gender_M"]], dtype=np.float32)
+        self.ages = self.metadata["Age"].to_numpy(dtype=np.float32)
+        self.subjects = self.metadata["Subject"].to_numpy()
+
+        # the volumes of all the subjects (of all the splits) in one memory mapped store, served by slicing
+        self.volume_store = None
+        if volume_store:
+            all_subjects = pd.read_csv(os.path.join(metadata_dir, "metadata_age_prediction.csv"))["Subject"]
+            self.volume_store = VolumeStore.build(data_dir, all_subjects, store_dir)
+            self.store_rows = self.volume_store.rows(self.subjects)
+
+        # identifies the content of the dataset for caching statistics computed over it (e.g. for initializations)
+        self.stats_key = f"BrainAge-{data_type}-{data_dir}-{transform}-{pd.util.hash_pandas_object(self.metadata).sum()}"
+
     def __len__(self):
         return len(self.metadata)
 
     def __getitem__(self, index):
-        gender = np.array(self.metadata.loc[index, ["Gender_F", "Gender_M"]]).astype(np.float32)
-        age = np.array(self.metadata.loc[index, "Age"]).astype(np.float32)
+        gender, age = self.genders[index], self.ages[index]
         if self.only_tabular:
             return np.zeros((1, 1, 1, 1)), gender, age
 
-        subject = self.metadata.loc[index, "Subject"]
-        img_path = os.path.join(self.data_dir, f"{subject}.npy")
-        img = np.load(img_path)
+        if self.volume_store is not None:
+            img = self.volume_store.volumes[self.store_rows[index]]  # a zero copy slice
+        else:
+            subject = self.subjects[index]
+            img_path = os.path.join(self.data_dir, f"{subject}.npy")
+            img = np.load(img_path)
 
         if self.transform is not None:
             img = self.transform(img)
@@ -109,3 +181,17 @@ def copy_data_to_server(metadata_path, dest_dir):
 
         dest_path = os.path.join(dest_dir, subject + ".npy")
         shutil.copyfile(img_path, dest_path)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description="build the memory mapped volume store of the brain age dataset")
+    parser.add_argument("--data_dir", type=str, required=True, help="the dir of the {subject}.npy volumes")
+    parser.add_argument("--metadata_dir", type=str, required=True, help="the dir of metadata_age_prediction.csv")
+    parser.add_argument("--store_dir", type=str, default=None, help="default: under the cache dir")
+    args = parser.parse_args()
+
+    subjects = pd.read_csv(os.path.join(args.metadata_dir, "metadata_age_prediction.csv"))["Subject"]
+    store = VolumeStore.build(args.data_dir, subjects, args.store_dir)
+    print(f"the volume store of {len(store.row_of)} subjects is at {store.store_dir}")
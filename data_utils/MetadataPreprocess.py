@@ -7,6 +7,7 @@ from sklearn.impute import IterativeImputer
 from sklearn.model_selection import StratifiedKFold
 from sklearn.linear_model import LinearRegression
 from tqdm import tqdm
+from utils.cache_utils import cache_path, hash_key, hash_file, atomic_write, file_lock
 
 features_sets = {}
 # --------------- features_set 0 ------------------
@@ -239,146 +240,273 @@ features_sets[set_num]["preprocess_dict"] = {
 
 
 def gauss_1d(n=10,sigma=1, mu=None):
+    # mu can be an array of means - then a gaussian (a row) per mean
     if mu is None:
         mu = n//2
-    r = range(n)
-    gaussian = np.array([1 / (sigma * np.sqrt(2*np.pi)) * np.exp(-float(x - mu)**2/(2*sigma**2)) for x in r])
+    x = np.arange(n, dtype=np.float64)
+    mu = np.asarray(mu, dtype=np.float64)[..., None]
+    gaussian = 1 / (sigma * np.sqrt(2*np.pi)) * np.exp(-(x - mu)**2/(2*sigma**2))
     gaussian[gaussian < 1e-8] = 0
-    gaussian /= gaussian.sum()  # normalize to sum to 1
+    gaussian /= gaussian.sum(axis=-1, keepdims=True)  # normalize to sum to 1
     return gaussian
 
 def preprocess_df_columns(csv, col_namesNoperations_dict: dict, split_seed=0, fold=0):
     """ col_namesNoperations_dict is an ordered dict of operations
     to do at each column in the following form:
     {col_name1:[op1,op2,op3..] , col_name2:[op1, ...]} """
-
-    for col_name in tqdm(col_namesNoperations_dict.keys(), "preprpcessing tabular data"):
-        operations = col_namesNoperations_dict[col_name]
-        for operation in operations:
-            if operation == "one_hot with_na":
-                csv = pd.get_dummies(csv, dummy_na=True, columns=[col_name])
-            elif operation == "one_hot without_na":
-                csv = pd.get_dummies(csv, dummy_na=False, columns=[col_name])
-
-            elif operation == "AGE_smoothed_one_hot":
-                n = int(csv["AGE"].max() - csv["AGE"].min()) + 1
-                smoothed_ages = []
-                for age in csv["AGE"]:
-                    smoothed_ages.append(gauss_1d(n=n, sigma=1, mu=age - csv["AGE"].min()))
-                # csv[col_name] = csv[col_name].round()
-                cols = ["AGE_{}".format(i + int(csv["AGE"].min())) for i in range(n)]
-                csv[cols] = smoothed_ages
-                csv.drop('AGE', inplace=True, axis=1)
-
-            elif operation == "AGE_binary_cutoff_69":
-                csv["AGE"][csv["AGE"] <= 69] = 0
-                csv["AGE"][csv["AGE"] > 69] = 1
-
-            elif operation == "norm min-max":
-                csv[col_name] = (csv[col_name] - csv[col_name].min())/(csv[col_name].max() - csv[col_name].min())
-            elif operation == "norm std-mean":
-                csv[col_name] = (csv[col_name] - csv[col_name].mean())/csv[col_name].std()
-            
-            elif operation == "add NaN col":  # adds a column named col_name_NaN with 1 in each NaN row of col_name
-                csv[col_name + '_nan'] = csv[col_name].isna().astype('int')
-            
-            elif operation == "fill NaN with median":
-                csv[col_name].fillna(csv[col_name].median(), inplace=True)
-            elif operation == "fill NaN with median w.r.t labels":
-                for label in csv["Group"].unique():
-                    labels_median = csv[col_name][csv["Group"] == label].median()
-                    csv[col_name][csv[col_name].isna() & (csv["Group"] == label)] = labels_median
-            elif operation == "fill NaN with mean":
-                csv[col_name].fillna(csv[col_name].mean(), inplace=True)
-
-            elif operation == "remove><":
-                for i in range(len(csv[col_name])):
-                    if csv[col_name][i] is not np.nan:
-                        if (csv[col_name][i][0] == '<') or (csv[col_name][i][0] == '>'):
-                            csv.loc[i, col_name] = csv[col_name][i][1:]
-                    if csv[col_name][i] is not np.nan:
-                        csv.loc[i, col_name] = float(csv[col_name][i])
-
-            elif ("impute_all" in operation) and col_name == "all_together":
+    return MetadataPreprocessor(col_namesNoperations_dict, split_seed, fold).fit_transform(csv)
+
+
+class MetadataPreprocessor:
+    """ the operations of a preprocess dict (see preprocess_df_columns) as a fitted transformer.
+    fit_transform computes the statistics of the operations (medians, means & stds, one hot vocabularies, imputers)
+    on the given metadata and returns it preprocessed; transform applies the fitted operations to new rows (e.g. a
+    single new patient, without its Group) - so training and inference share the exact same features """
+    def __init__(self, col_namesNoperations_dict: dict, split_seed=0, fold=0):
+        self.col_namesNoperations_dict = col_namesNoperations_dict
+        self.split_seed = split_seed
+        self.fold = fold
+        self.input_columns = None
+        self.stats = {}  # (col_name, operation index) -> the fitted statistics of the operation
+
+    def fit(self, csv):
+        self.fit_transform(csv)
+        return self
+
+    def fit_transform(self, csv):
+        self.input_columns = list(csv.columns)
+        self.stats = {}
+        return self.apply(csv, fit=True)
+
+    def transform(self, csv):
+        assert self.input_columns is not None, "the preprocessor is not fitted!"
+        csv = csv.loc[:, [col for col in self.input_columns if col in csv.columns]]
+        return self.apply(csv, fit=False)
+
+    def save(self, path):
+        atomic_write(path, lambda tmp_path: pd.to_pickle(self, tmp_path))
+
+    @staticmethod
+    def load(path):
+        return pd.read_pickle(path)
+
+    def apply(self, csv, fit):
+        csv = csv.reset_index(drop=True)
+        for col_name in tqdm(self.col_namesNoperations_dict.keys(), "preprpcessing tabular data", disable=not fit):
+            operations = self.col_namesNoperations_dict[col_name]
+            for op_idx, operation in enumerate(operations):
+                csv = self.apply_operation(csv, col_name, operation, (col_name, op_idx), fit)
+        return csv
+
+    def apply_operation(self, csv, col_name, operation, key, fit):
+        id_cols = [col for col in ["Subject", "Group"] if col in csv.columns]  # (new rows may have no Group)
+
+        if operation in ["one_hot with_na", "one_hot without_na"]:
+            if fit:
+                self.stats[key] = pd.Categorical(csv[col_name]).categories  # the (sorted) vocabulary
+            dummies = pd.get_dummies(pd.Categorical(csv[col_name], categories=self.stats[key]), prefix=col_name,
+                                     dummy_na=(operation == "one_hot with_na"))
+            csv = pd.concat([csv.drop(col_name, axis=1), dummies.set_index(csv.index)], axis=1)
+
+        elif operation == "AGE_smoothed_one_hot":
+            if fit:
+                self.stats[key] = (int(csv["AGE"].max() - csv["AGE"].min()) + 1, csv["AGE"].min())
+            n, age_min = self.stats[key]
+            smoothed_ages = gauss_1d(n=n, sigma=1, mu=csv["AGE"].to_numpy() - age_min)
+            # csv[col_name] = csv[col_name].round()
+            cols = ["AGE_{}".format(i + int(age_min)) for i in range(n)]
+            csv[cols] = smoothed_ages
+            csv.drop('AGE', inplace=True, axis=1)
+
+        elif operation == "AGE_binary_cutoff_69":
+            csv.loc[csv["AGE"] <= 69, "AGE"] = 0
+            csv.loc[csv["AGE"] > 69, "AGE"] = 1
+
+        elif operation == "norm min-max":
+            if fit:
+                self.stats[key] = (csv[col_name].min(), csv[col_name].max())
+            col_min, col_max = self.stats[key]
+            csv[col_name] = (csv[col_name] - col_min)/(col_max - col_min)
+        elif operation == "norm std-mean":
+            if fit:
+                self.stats[key] = (csv[col_name].mean(), csv[col_name].std())
+            col_mean, col_std = self.stats[key]
+            csv[col_name] = (csv[col_name] - col_mean)/col_std
+
+        elif operation == "add NaN col":  # adds a column named col_name_NaN with 1 in each NaN row of col_name
+            csv[col_name + '_nan'] = csv[col_name].isna().astype('int')
+
+        elif operation == "fill NaN with median":
+            if fit:
+                self.stats[key] = csv[col_name].median()
+            csv[col_name].fillna(self.stats[key], inplace=True)
+        elif operation == "fill NaN with median w.r.t labels":
+            if fit:
+                self.stats[key] = csv.groupby("Group")[col_name].median()
+            if "Group" not in csv.columns:
+                raise ValueError(f"'{operation}' of column '{col_name}' needs the Group of the rows")
+            csv[col_name] = csv[col_name].fillna(csv["Group"].map(self.stats[key]))
+        elif operation == "fill NaN with mean":
+            if fit:
+                self.stats[key] = csv[col_name].mean()
+            csv[col_name].fillna(self.stats[key], inplace=True)
+
+        elif operation == "remove><":  # values beyond the detection range ('<200', '>1700') as numbers
+            # only the string cells are parsed - new patients' frames may hold numbers (or a float64 column)
+            values = csv[col_name].astype(object)
+            strings = values[values.map(lambda value: isinstance(value, str))]
+            values[strings.index] = pd.to_numeric(strings.str.replace(r"^[<>]", "", n=1, regex=True))
+            csv[col_name] = values.astype(float).astype(object).where(values.notna(), np.nan)
+
+        elif ("impute_all" in operation) and col_name == "all_together":
+            if fit:
                 add_indicator = True if "Nan_col" in operation else False
                 imp = IterativeImputer(max_iter=200, initial_strategy="median", random_state=0, add_indicator=add_indicator)
-                cols = list(csv.columns)
-                cols.remove("Subject")
-                cols.remove("Group")
+                cols = [col for col in csv.columns if col not in id_cols]
                 imputed_csv = imp.fit_transform(csv[cols])
                 new_cols = [col for col in cols]
                 if add_indicator:
                     for col in cols:
                         if csv[col].isna().sum() > 0:
                             new_cols.append(f"{col}_Na")
-                df = pd.DataFrame(data=imputed_csv, columns=new_cols)
-                df[["Group", "Subject"]] = csv[["Group", "Subject"]]
-                csv = df
-
-
-            elif operation == "normalize_all" and col_name == "all_together":
-                cols = list(csv.columns)
-                cols.remove("Subject")
-                cols.remove("Group")
-                csv[cols] = (csv[cols] - csv[cols].mean()) / csv[cols].std()
-
-            elif operation == "normalize_all_but_Na" and col_name == "all_together":
-                cols = [c for c in csv.columns if "Na" not in c]
-                cols.remove("Subject")
-                cols.remove("Group")
-                csv[cols] = (csv[cols] - csv[cols].mean()) / csv[cols].std()
-
-            elif operation == "normalize_all_but_Na&Gender" and col_name == "all_together":
-                cols = [c for c in csv.columns if "Na" not in c]
-                cols.remove("Subject")
-                cols.remove("Group")
-                cols.remove("PTGENDER_Male")
-                cols.remove("PTGENDER_Female")
-                csv[cols] = (csv[cols] - csv[cols].mean()) / csv[cols].std()
-
-
-
-            elif operation == "delete_nan":
-                csv = csv[~csv[col_name].isna()]
-                csv.reset_index(drop=True, inplace=True)
-
-            elif operation == "fill_NaN_by_group":
-                skf = StratifiedKFold(n_splits=5, random_state=split_seed, shuffle=True)
-                X = csv.drop(['Subject', 'Group'], axis=1)
-                y = csv["Group"]
-                list_of_splits = list(skf.split(X, y))
-                _, val_idxs = list_of_splits[fold]
-                _, test_idxs = list_of_splits[4]
-                train_idxs = list(np.where(~csv.index.isin(list(val_idxs) + list(test_idxs)))[0])
-
-                # impute the training set with the help of all the values (including the group)
-                tmp = csv.copy()
-                tmp = pd.get_dummies(tmp, dummy_na=False, columns=["Group"])
-                cols =list(tmp.columns)
-                cols.remove("Subject")
-                imp = IterativeImputer(max_iter=200, initial_strategy="median", random_state=0, add_indicator=False)
-                tmp.loc[train_idxs, cols] = pd.DataFrame(data=imp.fit_transform(tmp.loc[train_idxs, cols]), columns=cols, index=train_idxs)
-                cols =list(csv.columns)
-                cols.remove("Group")
+                self.stats[key] = (imp, cols, new_cols)
+            else:
+                imp, cols, new_cols = self.stats[key]
+                imputed_csv = imp.transform(csv[cols])
+            df = pd.DataFrame(data=imputed_csv, columns=self.stats[key][2])
+            id_cols = [col for col in ["Group", "Subject"] if col in csv.columns]
+            df[id_cols] = csv[id_cols]
+            csv = df
+
+        elif operation in ["normalize_all", "normalize_all_but_Na", "normalize_all_but_Na&Gender"] and col_name == "all_together":
+            if fit:
+                if operation == "normalize_all":
+                    cols = list(csv.columns)
+                else:
+                    cols = [c for c in csv.columns if "Na" not in c]
                 cols.remove("Subject")
-                csv.loc[train_idxs, cols] = tmp.loc[train_idxs, cols]
-
-                # impute the test and validation set without the group column
-                cols =list(csv.columns)
                 cols.remove("Group")
-                cols.remove("Subject")
-                imp = IterativeImputer(max_iter=200, initial_strategy="median", random_state=0, add_indicator=False)
-                csv.loc[val_idxs, cols] = pd.DataFrame(data=imp.fit_transform(csv.loc[val_idxs, cols]), columns=cols, index=val_idxs)
-                imp = IterativeImputer(max_iter=200, initial_strategy="median", random_state=0, add_indicator=False)
-                csv.loc[test_idxs, cols] = pd.DataFrame(data=imp.fit_transform(csv.loc[test_idxs, cols]), columns=cols, index=test_idxs)
-
-            else:
-                raise AssertionError(f"operation '{operation}' for column '{col_name}' in preprocess_columns function is'nt from the optional actions")
-    return csv
-
-
-def create_metadata_csv(features_set_idx, csv_path="/home/duenias/PycharmProjects/HyperNetworks/ADNI_2023/my_adnimerege.csv",
-                        split_seed=0, fold=0):
+                if operation == "normalize_all_but_Na&Gender":
+                    cols.remove("PTGENDER_Male")
+                    cols.remove("PTGENDER_Female")
+                self.stats[key] = (cols, csv[cols].mean(), csv[cols].std())
+            cols, cols_mean, cols_std = self.stats[key]
+            csv[cols] = (csv[cols] - cols_mean) / cols_std
+
+        elif operation == "delete_nan":
+            csv = csv[~csv[col_name].isna()]
+            csv.reset_index(drop=True, inplace=True)
+
+        elif operation == "fill_NaN_by_group" and fit:
+            skf = StratifiedKFold(n_splits=5, random_state=self.split_seed, shuffle=True)
+            X = csv.drop(['Subject', 'Group'], axis=1)
+            y = csv["Group"]
+            list_of_splits = list(skf.split(X, y))
+            _, val_idxs = list_of_splits[self.fold]
+            _, test_idxs = list_of_splits[4]
+            train_idxs = list(np.where(~csv.index.isin(list(val_idxs) + list(test_idxs)))[0])
+
+            # impute the training set with the help of all the values (including the group)
+            tmp = csv.copy()
+            tmp = pd.get_dummies(tmp, dummy_na=False, columns=["Group"])
+            cols =list(tmp.columns)
+            cols.remove("Subject")
+            imp = IterativeImputer(max_iter=200, initial_strategy="median", random_state=0, add_indicator=False)
+            tmp.loc[train_idxs, cols] = pd.DataFrame(data=imp.fit_transform(tmp.loc[train_idxs, cols]), columns=cols, index=train_idxs)
+            cols =list(csv.columns)
+            cols.remove("Group")
+            cols.remove("Subject")
+            csv.loc[train_idxs, cols] = tmp.loc[train_idxs, cols]
+
+            # impute the test and validation set without the group column
+            cols =list(csv.columns)
+            cols.remove("Group")
+            cols.remove("Subject")
+            imp = IterativeImputer(max_iter=200, initial_strategy="median", random_state=0, add_indicator=False)
+            csv.loc[val_idxs, cols] = pd.DataFrame(data=imp.fit_transform(csv.loc[val_idxs, cols]), columns=cols, index=val_idxs)
+            imp = IterativeImputer(max_iter=200, initial_strategy="median", random_state=0, add_indicator=False)
+            csv.loc[test_idxs, cols] = pd.DataFrame(data=imp.fit_transform(csv.loc[test_idxs, cols]), columns=cols, index=test_idxs)
+            # new rows are imputed like the test set - without their group
+            self.stats[key] = (imp, cols)
+        elif operation == "fill_NaN_by_group":
+            imp, cols = self.stats[key]
+            csv[cols] = imp.transform(csv[cols])
+
+        else:
+            raise AssertionError(f"operation '{operation}' for column '{col_name}' in preprocess_columns function is'nt from the optional actions")
+        return csv
+
+
+# operations whose output depends on the split (split_seed, fold) - all the others depend on the csv only
+FOLD_DEPENDENT_OPERATIONS = ["fill_NaN_by_group"]
+DEFAULT_CSV_PATH = "/home/duenias/PycharmProjects/HyperNetworks/ADNI_2023/my_adnimerege.csv"
+
+
+def metadata_cache_path(features_set_idx, csv_path=DEFAULT_CSV_PATH, split_seed=0, fold=0):
+    # the cache entry (without extension) of a features set, keyed by the csv content and the preprocess dict - and
+    # by the split only if one of its operations depends on it, so the folds and seeds share the others
+    preprocess_dict = features_sets[features_set_idx]["preprocess_dict"]
+    fold_dependent = any(op in FOLD_DEPENDENT_OPERATIONS for ops in preprocess_dict.values() for op in ops)
+    split = (split_seed, fold) if fold_dependent else None
+    key = hash_key(hash_file(csv_path), features_sets[features_set_idx], split)
+    return cache_path("metadata", f"fs{features_set_idx}-{key}")
+
+
+def save_metadata(path, metadata):
+    # parquet when pyarrow is installed and the table reads back identical, a pickle otherwise
+    def write_parquet(tmp_path):
+        metadata.to_parquet(tmp_path)
+        if not pd.read_parquet(tmp_path).equals(metadata):  # e.g. object columns of floats come back as float64
+            raise ValueError("the parquet file does not reproduce the metadata")
+
+    try:
+        atomic_write(path + ".parquet", write_parquet)
+    except (ImportError, ValueError, TypeError, NotImplementedError):
+        atomic_write(path + ".pkl", lambda tmp_path: metadata.to_pickle(tmp_path))
+
+
+def load_metadata(path):
+    if os.path.exists(path + ".parquet"):
+        return pd.read_parquet(path + ".parquet")
+    if os.path.exists(path + ".pkl"):
+        return pd.read_pickle(path + ".pkl")
+    return None
+
+
+def create_metadata_csv(features_set_idx, csv_path=DEFAULT_CSV_PATH, split_seed=0, fold=0, use_cache=True):
+    if use_cache:
+        adni_csv = load_metadata(metadata_cache_path(features_set_idx, csv_path, split_seed, fold))
+        if adni_csv is not None:
+            return adni_csv
+    return fit_metadata_preprocessor(features_set_idx, csv_path, split_seed, fold, use_cache)[1]
+
+
+def fit_metadata_preprocessor(features_set_idx, csv_path=DEFAULT_CSV_PATH, split_seed=0, fold=0, use_cache=True):
+    """ (the MetadataPreprocessor of the features set fitted on the csv, the preprocessed csv) - both are cached.
+    concurrent jobs wait on a lock of the cache entry instead of repeating (and racing on) the same fit """
+    if not use_cache:
+        return fit_metadata_preprocessor_uncached(features_set_idx, csv_path, split_seed, fold)
+
+    path = metadata_cache_path(features_set_idx, csv_path, split_seed, fold)
+    cached = load_metadata_preprocessor(path)
+    if cached is None:
+        with file_lock(path):
+            cached = load_metadata_preprocessor(path)  # computed by another job while this one waited
+            if cached is None:
+                cached = fit_metadata_preprocessor_uncached(features_set_idx, csv_path, split_seed, fold)
+                cached[0].save(path + "_preprocessor.pkl")
+                save_metadata(path, cached[1])  # written last - marks a complete entry
+    return cached
+
+
+def load_metadata_preprocessor(path):
+    adni_csv = load_metadata(path)
+    if adni_csv is None or not os.path.exists(path + "_preprocessor.pkl"):
+        return None
+    return MetadataPreprocessor.load(path + "_preprocessor.pkl"), adni_csv
+
+
+def fit_metadata_preprocessor_uncached(features_set_idx, csv_path=DEFAULT_CSV_PATH, split_seed=0, fold=0):
     global features_sets
 
     features_lst = features_sets[features_set_idx]["features"]
@@ -389,10 +517,11 @@ def create_metadata_csv(features_set_idx, csv_path="/home/duenias/PycharmProject
     features_lst = features_lst + ['Subject', 'Group']  # add the target and the Subject id
     adni_csv = adni_csv.loc[:, features_lst]
 
-    adni_csv = preprocess_df_columns(adni_csv, features_preprocess_dict, split_seed, fold)
+    preprocessor = MetadataPreprocessor(features_preprocess_dict, split_seed, fold)
+    adni_csv = preprocessor.fit_transform(adni_csv)
+    return preprocessor, adni_csv
+
 
-    return adni_csv
-  
 def feature_properties(df_col):
     # feature_properties(adni_csv["CDRSB"])
     print(f"column name: {df_col.name}")
@@ -403,3 +532,49 @@ def feature_properties(df_col):
     df_col.hist()
     plt.show()
 
+
+def precompute_metadata(job):
+    # a worker of the precompute grid - the result stays in the cache, only the path is sent back
+    features_set_idx, csv_path, split_seed, fold = job
+    fit_metadata_preprocessor(features_set_idx, csv_path, split_seed, fold)
+    return metadata_cache_path(features_set_idx, csv_path, split_seed, fold)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    parser = ArgumentParser(description="precompute the preprocessed metadata of the features sets for the folds & seeds")
+    parser.add_argument("--csv_path", type=str, default=DEFAULT_CSV_PATH)
+    parser.add_argument("--features_sets", type=int, nargs="+", default=sorted(features_sets.keys()))
+    parser.add_argument("--split_seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--folds", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--max_pending", type=int, default=None,
+                        help="max jobs submitted at once (bounds the memory of the queue), default: the workers")
+    args = parser.parse_args()
+
+    # one job per cache entry - the features sets that don't depend on the split are computed once
+    jobs = {}
+    for features_set_idx in args.features_sets:
+        for split_seed in args.split_seeds:
+            for fold in args.folds:
+                path = metadata_cache_path(features_set_idx, args.csv_path, split_seed, fold)
+                if load_metadata(path) is None or not os.path.exists(path + "_preprocessor.pkl"):
+                    jobs.setdefault(path, (features_set_idx, args.csv_path, split_seed, fold))
+    print(f"{len(jobs)} entries to compute")
+
+    jobs = iter(jobs.values())
+    max_pending = args.max_pending or args.workers
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        pending = set()
+        while True:
+            for job in jobs:  # refill the queue up to max_pending
+                pending.add(executor.submit(precompute_metadata, job))
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                print(f"cached {future.result()}")
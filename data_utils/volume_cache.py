@@ -0,0 +1,176 @@
+import os
+import inspect
+import numpy as np
+import pandas as pd
+import monai
+import nibabel as nib
+from utils.cache_utils import cache_path, hash_key, atomic_write
+
+
+def scan_paths(adni_dir, subject, with_skull=False, no_bias_field_correct=False):
+    # the nifti files of a subject's scan: the scan and (without the skull) its brain mask
+    scan_name = "brain_scan_simple.nii.gz" if no_bias_field_correct else "brain_scan.nii.gz"
+    paths = [os.path.join(adni_dir, subject, scan_name)]
+    if not with_skull:
+        paths.append(os.path.join(adni_dir, subject, "brain_mask.nii.gz"))
+    return paths
+
+
+def load_scan(adni_dir, subject, with_skull=False, no_bias_field_correct=False):
+    paths = scan_paths(adni_dir, subject, with_skull, no_bias_field_correct)
+    img = nib.load(paths[0]).get_fdata()
+    if not with_skull:
+        img = img * nib.load(paths[1]).get_fdata()  # apply the brain mask
+    return img
+
+
+def preprocess_scan(adni_dir, subject, prefix_tforms, with_skull=False, no_bias_field_correct=False):
+    # the (1, D, H, W) float32 scan after the prefix transforms
+    img = load_scan(adni_dir, subject, with_skull, no_bias_field_correct)[None, ...]
+    for tform in prefix_tforms:
+        img = tform(img)
+    return np.asarray(img, dtype=np.float32)
+
+
+def split_deterministic_prefix(tform):
+    # (the leading deterministic transforms, the rest) of a transform - the output of the prefix is what gets
+    # cached and stored. it stops at the first random transform, and before the intensity normalization - the
+    # stored volumes may be quantized, and are dequantized right before it
+    if tform is None:
+        return [], []
+    transforms = list(tform.transforms) if isinstance(tform, monai.transforms.Compose) else [tform]
+    prefix_len = 0
+    while prefix_len < len(transforms) and not isinstance(transforms[prefix_len], (monai.transforms.Randomizable,
+                                                                                   monai.transforms.NormalizeIntensity)):
+        prefix_len += 1
+    return transforms[:prefix_len], transforms[prefix_len:]
+
+
+STORAGE_DTYPES = ("float32", "float16", "uint16", "uint8")
+
+
+def quantize_volume(img, storage_dtype="float32"):
+    # (stored, scale, offset) such that img ~= stored * scale + offset. the integer dtypes map the intensity range
+    # of the volume to the full range of the dtype - a zero background stays exactly zero as the intensities of
+    # the (masked) scans are non negative
+    storage_dtype = np.dtype(storage_dtype)
+    img = np.asarray(img, dtype=np.float32)
+    if storage_dtype.kind == "f":
+        # scaled only if the intensities overflow the dtype
+        max_abs = float(np.abs(img).max()) if img.size else 0.0
+        scale = max_abs / float(np.finfo(storage_dtype).max) if max_abs > np.finfo(storage_dtype).max else 1.0
+        return (img / np.float32(scale)).astype(storage_dtype), scale, 0.0
+    offset = float(img.min())
+    value_range = float(img.max()) - offset
+    scale = value_range / np.iinfo(storage_dtype).max if value_range > 0 else 1.0
+    return np.rint((img - offset) / scale).astype(storage_dtype), scale, offset
+
+
+def dequantize_volume(stored, scale=1.0, offset=0.0):
+    img = np.array(stored, dtype=np.float32)  # always a copy - the augmentations may work in place
+    if scale != 1.0 or offset != 0.0:
+        img = img * np.float32(scale) + np.float32(offset)
+    return img
+
+
+def tform_signature(tform):
+    # what a deterministic transform does: the source of a function (e.g. the crop lambdas) or the class and
+    # the settings of a monai transform - editing a transform changes the cache key of its outputs
+    if inspect.isfunction(tform):
+        return inspect.getsource(tform).strip()
+    settings = {k: v for k, v in vars(tform).items() if isinstance(v, (int, float, str, bool, tuple, list, type(None)))}
+    return f"{type(tform).__module__}.{type(tform).__qualname__}{sorted(settings.items())}"
+
+
+class VolumeCache:
+    """ on disk cache of the scans after the deterministic prefix of their transform (the mask and the crop),
+    as .npy files of the storage dtype (with their scale and offset) under CACHE_DIR/adni_volumes, addressed by
+    the subject, the scan flags and the transform. transforms with an empty prefix (no crop, e.g. the ones that
+    start with a random flip) aren't cached - it would hold the full uncropped scans """
+    def __init__(self, adni_dir, with_skull=False, no_bias_field_correct=False, storage_dtype="float32"):
+        assert storage_dtype in STORAGE_DTYPES, f"storage_dtype must be one of {STORAGE_DTYPES}"
+        self.adni_dir = adni_dir
+        self.with_skull = with_skull
+        self.no_bias_field_correct = no_bias_field_correct
+        self.storage_dtype = storage_dtype
+        self.key = hash_key(os.path.abspath(adni_dir), with_skull, no_bias_field_correct, storage_dtype)
+
+    def path(self, subject, prefix_tforms):
+        tforms_key = hash_key(*[tform_signature(tform) for tform in prefix_tforms])
+        return cache_path("adni_volumes", self.key, tforms_key, f"{subject}.npy")
+
+    def load_stored(self, subject, prefix_tforms):
+        # (stored, scale, offset) of the scan after the prefix transforms. the cached array is memory mapped, so
+        # only the (cropped) array is read
+        if len(prefix_tforms) == 0:
+            # nothing to crop - the uncropped float scans would take several times the compressed dataset on disk
+            img = preprocess_scan(self.adni_dir, subject, prefix_tforms, self.with_skull, self.no_bias_field_correct)
+            return quantize_volume(img, self.storage_dtype)
+        path = self.path(subject, prefix_tforms)
+        qparams_path = path[:-len(".npy")] + "_qparams.npy"
+        if not os.path.exists(path):
+            img = preprocess_scan(self.adni_dir, subject, prefix_tforms, self.with_skull, self.no_bias_field_correct)
+            stored, scale, offset = quantize_volume(img, self.storage_dtype)
+            atomic_write(qparams_path, lambda tmp_path: np.save(tmp_path, np.array([scale, offset])))
+            atomic_write(path, lambda tmp_path: np.save(tmp_path, stored))  # written last - marks a complete entry
+        scale, offset = np.load(qparams_path)
+        return np.array(np.load(path, mmap_mode="r")), float(scale), float(offset)
+
+    def load(self, subject, prefix_tforms):
+        return dequantize_volume(*self.load_stored(subject, prefix_tforms))
+
+
+def storage_error(adni_dir, subject, prefix_tforms, storage_dtype, with_skull=False, no_bias_field_correct=False):
+    # the reconstruction error of storing the scan in storage_dtype
+    img = preprocess_scan(adni_dir, subject, prefix_tforms, with_skull, no_bias_field_correct)
+    error = float(np.abs(dequantize_volume(*quantize_volume(img, storage_dtype)) - img).max())
+    value_range = float(img.max() - img.min())
+    return dict(subject=subject, max_abs_error=error, max_rel_error=error / value_range if value_range > 0 else 0.0)
+
+
+def _prebuild_subject(args):
+    from data_utils.transformation import tform_dict
+    subject, cache_kwargs, tform_names = args
+    cache = VolumeCache(**cache_kwargs)
+    for tform_name in tform_names:
+        cache.load_stored(subject, split_deterministic_prefix(tform_dict[tform_name])[0])
+    return subject
+
+
+def _subject_storage_error(args):
+    from data_utils.transformation import tform_dict
+    subject, cache_kwargs, tform_names = args
+    prefix_tforms = split_deterministic_prefix(tform_dict[tform_names[0]])[0]
+    return storage_error(cache_kwargs["adni_dir"], subject, prefix_tforms, cache_kwargs["storage_dtype"],
+                         cache_kwargs["with_skull"], cache_kwargs["no_bias_field_correct"])
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+
+    parser = ArgumentParser(description="prebuild the ADNI volumes cache of the given transforms")
+    parser.add_argument("--adni_dir", type=str, required=True)
+    parser.add_argument("--tforms", type=str, nargs="+", default=["hippo_crop_2sides_for_load_2_ram_func", "hippo_crop_2sides"],
+                        help="names of transforms in data_utils/transformation.py (their deterministic prefix is cached)")
+    parser.add_argument("--with_skull", action="store_true", default=False)
+    parser.add_argument("--no_bias_field_correct", action="store_true", default=False)
+    parser.add_argument("--storage_dtype", type=str, default="float32", choices=STORAGE_DTYPES)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--report_csv", type=str, default=None,
+                        help="also write the max reconstruction error of the storage dtype per subject (first tform)")
+    args = parser.parse_args()
+
+    cache_kwargs = dict(adni_dir=args.adni_dir, with_skull=args.with_skull,
+                        no_bias_field_correct=args.no_bias_field_correct, storage_dtype=args.storage_dtype)
+    subjects = sorted(s for s in os.listdir(args.adni_dir) if os.path.isdir(os.path.join(args.adni_dir, s)))
+    jobs = [(subject, cache_kwargs, args.tforms) for subject in subjects]
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        for _ in tqdm(executor.map(_prebuild_subject, jobs, chunksize=4), total=len(jobs), desc="caching volumes"):
+            pass
+        if args.report_csv is not None:
+            report = pd.DataFrame(tqdm(executor.map(_subject_storage_error, jobs, chunksize=4), total=len(jobs),
+                                       desc="storage errors"))
+            report.to_csv(args.report_csv, index=False)
+            print(report[["max_abs_error", "max_rel_error"]].describe())
@@ -1,6 +1,8 @@
 from train import *
 from pl_wrap import *
 from models.model_ensemble import ModelsEnsembleClassification, ModelsEnsembleRegression
+from models.Hyperfusion.hyper_base import enable_weights_cache, weights_cache_info
+from models.Hyperfusion.specialize import SpecializedModel, unique_conditions, check_equivalence
 import re
 
 def main(config: EasyDict):
@@ -26,16 +28,18 @@ def main(config: EasyDict):
     # Callbacks:
     callbacks = [TimeEstimatorCallback(config.trainer.epochs)]
 
-    if len(config.trainer.gpu) > 1:
+    accelerator = config.trainer.get("accelerator", "gpu")
+    if accelerator == "gpu" and len(config.trainer.gpu) > 1:
         strategy = "dp"
     else:
         strategy = None
 
     # Create the trainer:
     trainer = pl.Trainer(
-        accelerator="gpu",
-        devices=config.trainer.gpu,
+        accelerator=accelerator,
+        devices=config.trainer.gpu if accelerator == "gpu" else 1,
         strategy=strategy,
+        precision=config.trainer.get("precision", 32),  # "bf16" - mixed precision, the hypernetworks stay fp32
         default_root_dir=config.checkpointing.ckpt_dir,
 
         logger=logger,
@@ -51,6 +55,9 @@ def main(config: EasyDict):
     )
     trainer.test(pl_model, datamodule=data_module)
 
+    if config.get("hyper_weights_cache", 0):
+        print("hypernetworks weights cache:", weights_cache_info(model))
+
 def get_ensemble_model(config):
     wrapper = globals()[config.lightning_wrapper.wrapper_name]
     versions = config.versions.split(",")
@@ -76,8 +83,16 @@ def get_ensemble_model(config):
             experiment_dir = os.path.join(config.checkpointing.ckpt_dir, experiment_name)
             model_path = os.path.join(experiment_dir, "best_val.ckpt")
             m = wrapper.load_from_checkpoint(model_path).model
+            if config.get("specialize", False):  # one static network per sex instead of the hypernetworks
+                data_module = config.data_module_instance
+                specialized = SpecializedModel(m, unique_conditions(data_module.train_ds.genders))
+                print("specialized model check:", check_equivalence(m, specialized, [next(iter(data_module.val_dataloader()))]))
+                m = specialized
             model.append(m)
 
+    if config.get("hyper_weights_cache", 0):  # cache the generated weights of repeating tabular inputs
+        enable_weights_cache(model, max_size=config.hyper_weights_cache)
+
     return model
 
 def arrange_config4task(config: EasyDict):
@@ -161,6 +176,7 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config_path', default=default_cfg_path, type=str, help="path to YAML config file")
     parser.add_argument('-d', '--debug', action='store_true', default=False)
+    parser.add_argument('--compile', action='store_true', default=False, help="torch.compile the model's forward")
     args = parser.parse_args()
 
     assert os.path.exists(args.config_path), f"config file '{args.config_path}' does not exist!"
@@ -180,5 +196,6 @@ if __name__ == '__main__':
         config.trainer.gpu = [1]
         config.wandb.enable = False
 
+    config.lightning_wrapper.compile = args.compile
     main(config)
 
@@ -18,6 +18,8 @@ cfg.wandb.project_name = "testing"
 
 cfg.experiment_name = f"HyperFusion{vers}-seed{seed}-fs{f_set}"
 cfg.model.model_name = "HyperFusion_AD"
+# cfg.model.hyper_recompute = ["block4"]  # regenerate the hyper weights of these layers in the backward (less memory)
+# cfg.model.fuse_hyper_generators = True  # generate the hyper weights over one fused parameter (slower in training when benchmarked)
 cfg.data_module.dataset_cfg.features_set = f_set
 cfg.trainer.epochs = 250
 cfg.lightning_wrapper.loss.class_weights = [1.1, 0.6962, 1.4]
@@ -24,6 +24,10 @@ seeds = [0, 1]
 versions = ["_v1", "_v2"]
 
 assert len(gpus) == 4
+# precompute the tabular preprocessing of the whole grid once (the runs then only read it from the cache)
+repo_dir = os.path.dirname(os.path.dirname(os.getcwd()))
+print(f"cd {repo_dir} && python3 -m data_utils.MetadataPreprocess --features_sets {' '.join(map(str, features_sets))} "
+      f"--split_seeds {' '.join(map(str, seeds))} --folds 0 1 2 3")
 for gpu, fold in zip(gpus, [0, 1, 2, 3]):
     print("")
     for features_set in features_sets:
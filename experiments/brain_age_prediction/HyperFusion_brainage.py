@@ -17,6 +17,8 @@ cfg.wandb.project_name = "testing_barainage"
 cfg.experiment_name = f"HyperFusion_Brainage{vers}"
 cfg.model.model_name = "HyperFusion_Brainage"
 cfg.trainer.epochs = 60
+# cfg.model.hyper_recompute = ["linear1"]  # regenerate the hyper weights of these layers in the backward (less memory)
+# cfg.model.fuse_hyper_generators = True  # generate the hyper weights over one fused parameter (slower in training when benchmarked)
 
 cfg.data_module.dataset_cfg.partial_data = None
 
@@ -0,0 +1,98 @@
+import os
+import copy
+import inspect
+import numpy as np
+import torch
+import torch.nn as nn
+from argparse import ArgumentParser
+from models.Hyperfusion.hyper_base import HyperConv3dLayer
+
+
+class OnnxExportWrapper(nn.Module):
+    # the models take one (image, tabular) tuple - the exported graph takes them as two named inputs
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image, tabular):
+        if hasattr(torch, "_check"):
+            torch._check(image.shape[0] == tabular.shape[0])  # one symbolic batch size for torch.export
+        return self.model((image, tabular))
+
+
+def prepare_for_export(model):
+    # an eval mode copy whose hyper convolutions run as im2col + batched matmul - the grouped convolution
+    # of the "batched" engine has batch size groups, which would fix the batch size of the exported graph
+    model = copy.deepcopy(model).eval()
+    for module in model.modules():
+        if isinstance(module, HyperConv3dLayer):
+            module.engine = "matmul"
+    return OnnxExportWrapper(model).eval()
+
+
+def export_onnx(model, onnx_path, image_shape, tabular_size, opset_version=None):
+    """ writes the model as an onnx graph with (image, tabular) inputs and a dynamic batch size.
+    needs the packages of requirements-onnx.txt """
+    wrapper = prepare_for_export(model)
+    image = torch.randn(2, 1, *image_shape)
+    tabular = torch.randn(2, tabular_size)
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    if "dynamic_shapes" in inspect.signature(torch.onnx.export).parameters:
+        # torch.export based exporter - the image and the tabular inputs share one symbolic batch size
+        batch = torch.export.Dim("batch")
+        dynamic_kwargs = dict(dynamo=True, dynamic_shapes={"image": {0: batch}, "tabular": {0: batch}})
+    else:
+        dynamic_kwargs = dict(dynamic_axes={"image": {0: "batch"}, "tabular": {0: "batch"}, "output": {0: "batch"}})
+    with torch.no_grad():
+        torch.onnx.export(wrapper, (image, tabular), onnx_path, input_names=["image", "tabular"],
+                          output_names=["output"], opset_version=opset_version, **dynamic_kwargs)
+    return onnx_path
+
+
+def check_parity(model, onnx_path, image_shape, tabular_size, batch_sizes=(1, 3), atol=1e-4, rtol=1e-3,
+                 tabular=None):
+    # compares the onnx runtime outputs with the pytorch (eval mode) outputs on random scans, for a few batch
+    # sizes. tabular - optional conditioning rows to sample from (e.g. one hot sex for the brain age models)
+    from utils.onnx_runner import OnnxRunner
+    runner = OnnxRunner(onnx_path)
+    was_training = model.training
+    model.eval()
+    max_abs_err = 0.0
+    for batch_size in batch_sizes:
+        image = torch.randn(batch_size, 1, *image_shape)
+        if tabular is None:
+            batch_tabular = torch.randn(batch_size, tabular_size)
+        else:
+            batch_tabular = tabular[torch.randint(len(tabular), (batch_size,))]
+        with torch.no_grad():
+            expected = model((image, batch_tabular)).numpy()
+        out = runner(image.numpy(), batch_tabular.numpy())
+        assert out.shape == expected.shape, f"onnx output shape {out.shape} != pytorch output shape {expected.shape}"
+        max_abs_err = max(max_abs_err, float(np.abs(out - expected).max()))
+        assert np.allclose(out, expected, atol=atol, rtol=rtol), \
+            f"onnx and pytorch outputs differ (batch size {batch_size}, max abs error {max_abs_err:.3g})"
+    model.train(was_training)
+    return max_abs_err
+
+
+if __name__ == '__main__':
+    from pl_wrap import PlModelWrapADcls, PlModelWrapBrainAge
+
+    parser = ArgumentParser(description="export a trained model checkpoint to onnx")
+    parser.add_argument('--ckpt_path', type=str, required=True, help="a best_val.ckpt of train.py")
+    parser.add_argument('--task', type=str, required=True, choices=["AD_classification", "brain_age_prediction"])
+    parser.add_argument('--image_shape', type=int, nargs=3, required=True, help="D H W of the input scans")
+    parser.add_argument('--tabular_size', type=int, required=True, help="number of tabular features")
+    parser.add_argument('-o', '--onnx_path', type=str, default=None, help="default: next to the checkpoint")
+    parser.add_argument('--opset', type=int, default=None, help="default: the exporter's default opset")
+    args = parser.parse_args()
+
+    wrapper = PlModelWrapADcls if args.task == "AD_classification" else PlModelWrapBrainAge
+    model = wrapper.load_from_checkpoint(args.ckpt_path, map_location="cpu").model
+    onnx_path = args.onnx_path or os.path.splitext(args.ckpt_path)[0] + ".onnx"
+
+    export_onnx(model, onnx_path, args.image_shape, args.tabular_size, opset_version=args.opset)
+    # the brain age models are conditioned on one hot sex
+    tabular = torch.eye(2) if args.task == "brain_age_prediction" else None
+    max_abs_err = check_parity(model, onnx_path, args.image_shape, args.tabular_size, tabular=tabular)
+    print(f"exported {type(model).__name__} to {onnx_path} (max abs error vs pytorch: {max_abs_err:.3g})")
@@ -20,9 +20,12 @@ class HyperFusion_AD(nn.Module):
         )
 
         #                                               [conv1 hyper, conv2 hyper, down-sample hyper]
-        resblock_hyper_kwargs = dict(hyper_embedding_models=[None, None, hyper_embeddings_tab])
-        fc1_hyper_kwargs = dict(embedding_model=None)
-        fc2_hyper_kwargs = dict(embedding_model=None)
+        # names of the hyper layers whose generated weights are regenerated in the backward instead of kept
+        recompute_layers = kwargs.get("hyper_recompute", [])
+        resblock_hyper_kwargs = dict(hyper_embedding_models=[None, None, hyper_embeddings_tab],
+                                     recompute="block4" in recompute_layers)
+        fc1_hyper_kwargs = dict(embedding_model=None, recompute="fc1" in recompute_layers)
+        fc2_hyper_kwargs = dict(embedding_model=None, recompute="fc2" in recompute_layers)
 
 
         general_hyper_kwargs = dict(
@@ -52,21 +55,28 @@ class HyperFusion_AD(nn.Module):
 
         self.relu = nn.ReLU()
 
+        # opt-in: the generators of the hyper layers are held in one persistent fused parameter (see HyperParameterBank)
+        if kwargs.get("fuse_hyper_generators", False):
+            self.hyper_bank = HyperParameterBank(self)
+
     def forward(self, x):
         image, tabular = x
 
-        out = self.conv_bn_relu(image)
-        out = self.max_pool3d_1(out)
-        out = self.block1(out)
-        out = self.block2(out)
-        out = self.block3(out)
-        out = self.block4((out, tabular))
-        out = self.adaptive_avg_pool3d(out)
-        out = out.view(out.size(0), -1)
-        out = self.linear_drop1(out)
-        out = self.fc1((out, tabular))
-        out = self.relu(out)
-        out = self.linear_drop2(out)
-        out = self.fc2((out, tabular))
+        # the tabular embedding is computed once (and with fuse_hyper_generators the hyper layers weights are
+        # generated together)
+        with hyper_forward_scope(self, tabular):
+            out = self.conv_bn_relu(image)
+            out = self.max_pool3d_1(out)
+            out = self.block1(out)
+            out = self.block2(out)
+            out = self.block3(out)
+            out = self.block4((out, tabular))
+            out = self.adaptive_avg_pool3d(out)
+            out = out.view(out.size(0), -1)
+            out = self.linear_drop1(out)
+            out = self.fc1((out, tabular))
+            out = self.relu(out)
+            out = self.linear_drop2(out)
+            out = self.fc2((out, tabular))
 
         return out
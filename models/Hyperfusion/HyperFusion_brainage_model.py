@@ -14,10 +14,12 @@ class HyperFusion_Brainage(nn.Module):
             layer.bias.data.fill_(0)
             hyper_embeddings.append(layer)
 
-        fc1_hyper_kwargs = dict(embedding_model=hyper_embeddings[0])
-        fc2_hyper_kwargs = dict(embedding_model=hyper_embeddings[1])
-        fc3_hyper_kwargs = dict(embedding_model=hyper_embeddings[2])
-        fc4_hyper_kwargs = dict(embedding_model=hyper_embeddings[3])
+        # names of the hyper layers whose generated weights are regenerated in the backward instead of kept
+        recompute_layers = kwargs.get("hyper_recompute", [])
+        fc1_hyper_kwargs = dict(embedding_model=hyper_embeddings[0], recompute="linear1" in recompute_layers)
+        fc2_hyper_kwargs = dict(embedding_model=hyper_embeddings[1], recompute="linear2" in recompute_layers)
+        fc3_hyper_kwargs = dict(embedding_model=hyper_embeddings[2], recompute="linear3" in recompute_layers)
+        fc4_hyper_kwargs = dict(embedding_model=hyper_embeddings[3], recompute="final_layer" in recompute_layers)
 
         general_hyper_kwargs = dict(
             embedding_output_size=embd_tab_out_size,
@@ -25,7 +27,8 @@ class HyperFusion_Brainage(nn.Module):
             hyper_input_type="tabular",
             train_loader=kwargs["train_loader"],
             GPU=kwargs["GPU"],
-            var_hypernet_input=0.25
+            var_hypernet_input=0.25,
+            dedup=True  # the hyper input is the one-hot sex - at most 2 distinct weights sets per batch
         )
 
         fc1_hyper_kwargs.update(general_hyper_kwargs)
@@ -51,38 +54,44 @@ class HyperFusion_Brainage(nn.Module):
         self.linear3 = LinearLayer(in_features=32, out_features=64, **fc3_hyper_kwargs)
         self.final_layer = LinearLayer(in_features=64, out_features=1, **fc4_hyper_kwargs)
 
+        # opt-in: the generators of the hyper layers are held in one persistent fused parameter (see HyperParameterBank)
+        if kwargs.get("fuse_hyper_generators", False):
+            self.hyper_bank = HyperParameterBank(self)
+
     def forward(self, x):
         image, tabular = x
 
-        out = self.conv1_a(image)
-        out = F.relu(out)
-        out = self.conv1_b(out)
-        out = F.relu(out)
-        out = F.max_pool3d(out, kernel_size=2, stride=2)
-        out = self.batchnorm1(out)
-
-        out = self.conv2_a(out)
-        out = F.relu(out)
-        out = self.conv2_b(out)
-        out = F.relu(out)
-        out = F.max_pool3d(out, kernel_size=2, stride=2)
-        out = self.batchnorm2(out)
-
-        out = self.conv3_a(out)
-        out = F.relu(out)
-        out = self.conv3_b(out)
-        out = F.relu(out)
-        out = F.max_pool3d(out, kernel_size=2, stride=2)
-        out = self.batchnorm3(out)
-
-        out = self.dropout1(out)
-        out = torch.flatten(out, start_dim=1)
-        out = self.linear1((out, tabular))
-        out = F.relu(out)
-        out = self.linear2((out, tabular))
-        out = F.relu(out)
-        out = self.linear3((out, tabular))
-        out = F.relu(out)
-        out = self.final_layer((out, tabular))
+        # with fuse_hyper_generators all the hyper layers weights are generated together at the start of the forward
+        with hyper_forward_scope(self, tabular):
+            out = self.conv1_a(image)
+            out = F.relu(out)
+            out = self.conv1_b(out)
+            out = F.relu(out)
+            out = F.max_pool3d(out, kernel_size=2, stride=2)
+            out = self.batchnorm1(out)
+
+            out = self.conv2_a(out)
+            out = F.relu(out)
+            out = self.conv2_b(out)
+            out = F.relu(out)
+            out = F.max_pool3d(out, kernel_size=2, stride=2)
+            out = self.batchnorm2(out)
+
+            out = self.conv3_a(out)
+            out = F.relu(out)
+            out = self.conv3_b(out)
+            out = F.relu(out)
+            out = F.max_pool3d(out, kernel_size=2, stride=2)
+            out = self.batchnorm3(out)
+
+            out = self.dropout1(out)
+            out = torch.flatten(out, start_dim=1)
+            out = self.linear1((out, tabular))
+            out = F.relu(out)
+            out = self.linear2((out, tabular))
+            out = F.relu(out)
+            out = self.linear3((out, tabular))
+            out = F.relu(out)
+            out = self.final_layer((out, tabular))
 
         return out[:, 0]
\ No newline at end of file
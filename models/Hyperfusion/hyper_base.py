@@ -1,19 +1,202 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 import numpy as np
+import time
+import itertools
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from utils.cache_utils import cache_path, hash_key, load_json, save_json
+
+LOW_RANK_MODES = ("factorized", "base_delta")
+
+# state that lives for one model forward, per thread (DataParallel replicas run in threads)
+_forward_scope = threading.local()
+
+
+def is_tracing():
+    # True while torch.compile or torch.jit.trace captures a graph of the forward. the data dependent python
+    # work of the hyper layers (deduplication, caches, engine timing) is skipped then, for one static graph
+    compiler = getattr(torch, "compiler", None)  # older torch versions have no torch.compile
+    if compiler is not None and hasattr(compiler, "is_compiling") and compiler.is_compiling():
+        return True
+    return torch.jit.is_tracing()
+
+
+def full_precision(x):
+    # the hypernetworks (embeddings and generators) run in fp32 under mixed precision autocast: the variance
+    # init of the generators (variance_uniform_init) sets the scale of the generated weights for fp32 outputs,
+    # and a bf16 generator GEMM would round them to 8 mantissa bits. the layers' convs / matmuls stay in bf16
+    return torch.autocast(device_type=x.device.type, enabled=False)
+
+
+@contextmanager
+def shared_embeddings():
+    """ within this context each (embedding model, input tensor) pair is embedded once and the output is
+    reused by every hyper layer that asks for it. wrap a model's forward with it """
+    outermost = getattr(_forward_scope, "embeddings", None) is None
+    if outermost:
+        _forward_scope.embeddings = {}
+    try:
+        yield
+    finally:
+        if outermost:
+            _forward_scope.embeddings = None
+
+
+def hyper_forward_scope(model, x):
+    """ the per forward state of the hyper layers of model conditioned on x - shared embeddings and, if the model
+    has a hyper_bank, the fused parameters generation (HyperParameterBank). while tracing it is skipped and each
+    hyper layer embeds and generates on its own: the thread local memos keyed by id() would break the graph """
+    if is_tracing():
+        return nullcontext()
+    bank = getattr(model, "hyper_bank", None)
+    if bank is None:
+        return shared_embeddings()
+    return _hyper_forward_scope(model, bank, x)
+
+
+@contextmanager
+def _hyper_forward_scope(model, bank, x):
+    with shared_embeddings(), bank.fused(model, x):
+        yield
+
+
+class ChunkedWeightsGenerator(nn.Module):
+    """ generates a long weights vector in fixed size chunks with one small generator shared by all the chunks.
+    chunk j is W (e x c_j) - bilinear in the hypernetwork embedding e and a learned embedding c_j of the chunk,
+    so the generated weights stay linear in e (as with nn.Linear) and the variance initialization still holds """
+    def __init__(self, in_features, out_features, chunk_size, chunk_embedding_size=8):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.chunk_size = chunk_size
+        self.chunk_embedding_size = chunk_embedding_size
+        self.num_chunks = int(np.ceil(out_features / chunk_size))
+
+        self.chunk_embeddings = nn.Parameter(torch.randn(self.num_chunks, chunk_embedding_size))  # unit variance
+        self.weight = nn.Parameter(torch.empty(chunk_size, in_features, chunk_embedding_size))
+        self.bias = nn.Parameter(torch.zeros(chunk_size))
+        fan_in = in_features * chunk_embedding_size
+        nn.init.uniform_(self.weight, -1 / np.sqrt(fan_in), 1 / np.sqrt(fan_in))
+
+    def forward(self, x):
+        # all the chunks of all the samples in one call: (batch, num_chunks, chunk_size)
+        chunks = torch.einsum('bd,kdm->bkm', x, self.weight)
+        chunks = torch.einsum('bkm,cm->bck', chunks, self.chunk_embeddings) + self.bias
+        return chunks.reshape(x.shape[0], -1)[:, :self.out_features]
+
+
+_input_variances = {}  # the statistics of the hypernetworks inputs, shared by all the layers of a model
+
+
+def hypernet_input_variance(train_dataloader, hyper_input_type, embedding_model=None,
+                            subsample=None, rel_tolerance=0.02, confidence_z=1.96, min_samples=32):
+    """ the mean over the training samples of the variance of each sample's hypernetwork input (or of its
+    embedding when embedding_model is given). computed once per (dataset, input type, embedding) with batched
+    tensor ops and cached in memory and on disk - only when the dataset defines a stats_key (object ids get
+    reused, so it's recomputed for a dataset without one).
+    subsample - max number of samples to use: stops as soon as the confidence interval of the mean is within
+    rel_tolerance of it (meant for the expensive image inputs) """
+    dataset = train_dataloader.dataset
+    embedding_hash = None
+    if embedding_model is not None:
+        embedding_hash = hash_key(*[t.detach().cpu().numpy().tobytes() for t in embedding_model.state_dict().values()])
+    dataset_key = getattr(dataset, "stats_key", None)
+    key = None
+    if dataset_key is not None:
+        key = hash_key(dataset_key, hyper_input_type, embedding_hash, subsample, rel_tolerance, confidence_z)
+        if key in _input_variances:
+            return _input_variances[key]
+        disk_path = cache_path("hypernet_input_stats", f"{key}.json")
+        stats = load_json(disk_path)
+        if stats is not None:
+            _input_variances[key] = stats["var_hypernet_input"]
+            return _input_variances[key]
+
+    hyper_input_type_dict = {"image": 0, "tabular": 1}
+    if hyper_input_type == "tabular":
+        only_tabular = dataset.only_tabular
+        dataset.only_tabular = True
+    variances = []
+    num_samples = 0
+    with torch.no_grad():
+        for batch in iter(train_dataloader):
+            # to choose the input for the hyper network - (image or tabular)
+            values = batch[hyper_input_type_dict[hyper_input_type]]
+            if embedding_model is not None:  # calculates tha variance after the embedding model
+                values = embedding_model(values)
+            variances.append(values.reshape(len(values), -1).double().var(dim=1, unbiased=False).cpu())
+            num_samples += len(values)
+
+            if (subsample is not None) and (num_samples >= min_samples):
+                all_variances = torch.cat(variances)
+                half_width = confidence_z * all_variances.std() / np.sqrt(num_samples)
+                if (half_width <= rel_tolerance * all_variances.mean()) or (num_samples >= subsample):
+                    print(f"hypernetwork input variance from {num_samples} samples: "
+                          f"{all_variances.mean():.4g} +- {half_width:.2g}")
+                    break
+    if hyper_input_type == "tabular":
+        dataset.only_tabular = only_tabular
+
+    var_hypernet_input = torch.cat(variances).mean().item()
+    if var_hypernet_input == 0:
+        var_hypernet_input = 1
+
+    if key is not None:
+        _input_variances[key] = var_hypernet_input
+        save_json(disk_path, dict(var_hypernet_input=var_hypernet_input, dataset=dataset_key, num_samples=num_samples,
+                                  hyper_input_type=hyper_input_type, embedding=embedding_hash))
+    return var_hypernet_input
+
 
 class HyperNetwork(nn.Module):
-    def __init__(self, embedding_model, embedding_output_size, num_weights, num_biases):
+    def __init__(self, embedding_model, embedding_output_size, num_weights, num_biases,
+                 rank=None, weights_shape2d=None, low_rank_mode="factorized",
+                 chunk_size=None, chunk_embedding_size=8):
         super().__init__()
         self.embedding_model = embedding_model
         self.embedding_model_params = [param for param in embedding_model.parameters() if param.requires_grad]
         self.num_weights = num_weights
         self.num_biases = num_biases
-        self.weights_gen = nn.Linear(in_features=embedding_output_size, out_features=self.num_weights)
+
+        # low rank generation: instead of the full (out x in) weights matrix, generate per sample the factors
+        # U (out x rank) and V (rank x in) of W = U V ("factorized") or of W = W_base + U V ("base_delta")
+        self.rank = rank
+        self.low_rank_mode = low_rank_mode
+        self.base_weights = None
+        num_generated_weights = self.num_weights
+        if rank is not None:
+            assert low_rank_mode in LOW_RANK_MODES, f"low_rank_mode must be one of {LOW_RANK_MODES}"
+            assert weights_shape2d is not None, "low rank generation needs the (out, in) shape of the weights"
+            self.weights_shape2d = tuple(weights_shape2d)
+            num_generated_weights = rank * sum(self.weights_shape2d)
+            if low_rank_mode == "base_delta":
+                self.base_weights = nn.Parameter(torch.empty(self.weights_shape2d))
+                nn.init.kaiming_uniform_(self.base_weights, a=np.sqrt(5))  # as in nn.Linear
+
+        # chunked generation: one small generator shared by all the chunks of the (possibly low rank) weights
+        self.chunk_size = chunk_size
+        if chunk_size is None:
+            self.weights_gen = nn.Linear(in_features=embedding_output_size, out_features=num_generated_weights)
+        else:
+            self.weights_gen = ChunkedWeightsGenerator(embedding_output_size, num_generated_weights,
+                                                       chunk_size, chunk_embedding_size)
         self.bias_gen = nn.Linear(in_features=embedding_output_size, out_features=num_biases)
         self.parameters_generators_input_size = embedding_output_size
 
+        # set by the hyper layer - generated parameters are recomputed in the backward instead of being kept
+        self.recompute = False
+        self.recompute_saved_bytes = 0
+
+        # LRU cache of generated parameters for inference (disabled by default, see enable_weights_cache)
+        self.weights_cache = None
+        self.weights_cache_size = 0
+        self.weights_cache_params_signature = None
+        self.cache_hits = self.cache_misses = 0
+
         # self.scale_weights = True
         # self.scale_factor_net = nn.Sequential(
         #     copy.deepcopy(embedding_model),
@@ -22,36 +205,41 @@ class HyperNetwork(nn.Module):
 
 
     def calc_variance4init(self, main_net_in_size, train_dataloader, hyper_input_type,
-                           embd_vars=False, main_net_relu=True, main_net_biasses=True, var_hypernet_input=None):
+                           embd_vars=False, main_net_relu=True, main_net_biasses=True, var_hypernet_input=None,
+                           variance_subsample=None):
         # initialize the weights and biasses of the weights geneerator
         if var_hypernet_input is None:
             # according to PRINCIPLED WEIGHT INITIALIZATION FOR HYPERNETWORKS
-            hyper_input_type_dict = {"image": 0, "tabular": 1}
-            if hyper_input_type == "tabular":
-                only_tabular = train_dataloader.dataset.only_tabular
-                train_dataloader.dataset.only_tabular = True
-            variances = []
-            for batch in iter(train_dataloader):
-                # to choose the input for the hyper network - (image or tabular)
-                values = batch[hyper_input_type_dict[hyper_input_type]]
-                if embd_vars:  # calculates tha variance after the embedding model
-                    values = self.embedding_model(values)
-                for v in values:
-                    variances += [np.array(v.view(-1).detach().cpu()).var()]
-            if hyper_input_type == "tabular":
-                train_dataloader.dataset.only_tabular = only_tabular
-
-            var_hypernet_input = np.mean(variances)
-            if var_hypernet_input == 0:
-                var_hypernet_input = 1
+            embedding_model = self.embedding_model if embd_vars else None  # variance after the embedding model
+            var_hypernet_input = hypernet_input_variance(train_dataloader, hyper_input_type, embedding_model,
+                                                         subsample=variance_subsample)
 
         # calculate the needed variance
         dk = self.parameters_generators_input_size  # both dk and dl
-        dj = main_net_in_size
-        var_weights_generator = (2 ** main_net_relu) / ((2 ** main_net_biasses) * dj * dk * var_hypernet_input)
+        var_main_net_weights = self.main_net_weights_variance(main_net_in_size, main_net_relu, main_net_biasses)
+        if self.rank is not None:
+            # W = U V sums rank products of two generated factors: Var(W) = rank * Var(U) * Var(V).
+            # the factors get equal variances and in "base_delta" mode the static base takes half of Var(W)
+            if self.low_rank_mode == "base_delta":
+                var_main_net_weights /= 2
+            var_main_net_weights = np.sqrt(var_main_net_weights / self.rank)
+        var_weights_generator = var_main_net_weights / (dk * var_hypernet_input)
+        if self.chunk_size is not None:
+            # each generated weight sums over all the (embedding x unit variance chunk embedding) products
+            var_weights_generator /= self.weights_gen.chunk_embedding_size
         var_biasses_generator = (2 ** main_net_relu) / (2 * dk * var_hypernet_input)
         return var_weights_generator, var_biasses_generator
 
+    @staticmethod
+    def main_net_weights_variance(main_net_in_size, main_net_relu=True, main_net_biasses=True):
+        dj = main_net_in_size
+        return (2 ** main_net_relu) / ((2 ** main_net_biasses) * dj)
+
+    def base_weights_uniform_init(self, main_net_in_size):
+        # the static base gets the half of the main net weights variance that the low rank delta doesn't
+        ws_init = np.sqrt(3 * self.main_net_weights_variance(main_net_in_size) / 2)
+        nn.init.uniform_(self.base_weights, -ws_init, ws_init)
+
     def variance_uniform_init(self, var_weights_generator, var_biasses_generator):
         # initialize the weights and biasses of the weights geneerator
         # according to PRINCIPLED WEIGHT INITIALIZATION FOR HYPERNETWORKS
@@ -67,18 +255,23 @@ class HyperNetwork(nn.Module):
         nn.init.constant_(self.bias_gen.bias, 0)
 
     def initialize_parameters(self, weights_init_method, fan_in, hyper_input_type,
-                              for_conv=False, train_loader=None, GPU=None, var_hypernet_input=None):
+                              for_conv=False, train_loader=None, GPU=None, var_hypernet_input=None,
+                              variance_subsample=None):
         if weights_init_method == "input_variance":
             print("input_variance weights initialization")
             var_w, var_b = self.calc_variance4init(fan_in, train_loader, hyper_input_type, embd_vars=False,
-                                                   var_hypernet_input=var_hypernet_input)
+                                                   var_hypernet_input=var_hypernet_input,
+                                                   variance_subsample=variance_subsample)
             self.variance_uniform_init(var_w, var_b)
         elif weights_init_method == "embedding_variance":
             print("embedding_variance weights initialization")
-            var_w, var_b = self.calc_variance4init(fan_in, train_loader, hyper_input_type, embd_vars=True)
+            var_w, var_b = self.calc_variance4init(fan_in, train_loader, hyper_input_type, embd_vars=True,
+                                                   variance_subsample=variance_subsample)
             self.variance_uniform_init(var_w, var_b)
         else:
             raise ValueError("HyperNetwork initialization type not implemented!")
+        if self.base_weights is not None:
+            self.base_weights_uniform_init(fan_in)
 
     def freeze_embedding_model(self):
         for param in self.embedding_model_params:
@@ -89,33 +282,415 @@ class HyperNetwork(nn.Module):
             param.requires_grad = True
 
     def forward(self, x):
-        emb_out = self.embedding_model(x)
-        weights = self.weights_gen(emb_out)
-        biases = self.bias_gen(emb_out)
+        if self.weights_cache_active():
+            return self.cached_forward(x)
+        banked = self.banked_parameters(x)
+        if banked is not None and banked[2] is None:
+            return banked[:2]
+        return self.generate(self.embed(x))
+
+    def banked_parameters(self, x):
+        # the (weights, biases, groups) generated for x by an active HyperParameterBank (if there is one).
+        # groups is None for parameters generated per sample, else the unique row of every sample
+        banked = None if is_tracing() else getattr(_forward_scope, "banked", None)
+        if banked is None or id(self) not in banked:
+            return None
+        bank_input, weights, biases, groups = banked[id(self)]
+        if bank_input is not x:
+            return None
+        return weights, biases, groups
+
+    def embed(self, x):
+        memo = None if is_tracing() else getattr(_forward_scope, "embeddings", None)
+        if memo is None:
+            with full_precision(x):
+                return self.embedding_model(x.float())
+        key = (id(self.embedding_model), id(x))
+        if key not in memo:
+            # the module and the input are kept alive in the memo so their ids can't be reused in this forward
+            with full_precision(x):
+                memo[key] = (self.embedding_model, x, self.embedding_model(x.float()))
+        return memo[key][2]
+
+    def generate(self, emb_out):
+        with full_precision(emb_out):
+            weights = self.weights_gen(emb_out.float())
+            biases = self.bias_gen(emb_out.float())
         return weights, biases
 
+    def forward_unique(self, x):
+        # generates the parameters once per unique conditioning row of the batch. the embedding still runs on
+        # the whole batch so normalization layers in it see the same batch statistics as without deduplication
+        if not self.weights_cache_active():
+            banked = self.banked_parameters(x)
+            if banked is not None and banked[2] is not None:
+                return banked
+        first_idxs, groups = unique_rows(x)
+        if self.weights_cache_active():
+            weights, biases = self.cached_forward(x[first_idxs])
+        else:
+            weights, biases = self.generate(self.embed(x)[first_idxs])
+        return weights, biases, groups
+
+    def enable_weights_cache(self, max_size=1024):
+        # caches the generated parameters per conditioning row in eval mode (and without grad) with LRU eviction
+        self.weights_cache = OrderedDict()
+        self.weights_cache_size = max_size
+        self.weights_cache_params_signature = None
+        self.cache_hits = self.cache_misses = 0
+
+    def disable_weights_cache(self):
+        self.weights_cache = None
+
+    def weights_cache_active(self):
+        return (self.weights_cache is not None) and (not self.training) and (not torch.is_grad_enabled()) \
+               and (not is_tracing())
+
+    def params_signature(self):
+        # in-place updates (optimizer steps, load_state_dict) bump the version of a parameter and moving
+        # the model changes its storage - either one means the cached parameters are stale
+        return tuple((param.data_ptr(), param._version) for param in self.parameters())
+
+    def cached_forward(self, x):
+        signature = self.params_signature()
+        if signature != self.weights_cache_params_signature:
+            self.weights_cache.clear()
+            self.weights_cache_params_signature = signature
+
+        keys = [row.tobytes() for row in x.reshape(x.shape[0], -1).cpu().numpy()]
+        missing = {}  # key -> first row index, for the keys that aren't cached
+        for i, key in enumerate(keys):
+            if (key not in self.weights_cache) and (key not in missing):
+                missing[key] = i
+        self.cache_misses += len(missing)
+        self.cache_hits += len(keys) - len(missing)
+        if len(missing) > 0:  # generate the parameters only for the rows that aren't cached
+            weights, biases = self.generate(self.embed(x[list(missing.values())]))
+            for key, w, b in zip(missing.keys(), weights, biases):
+                # copies - a row view would keep the whole batch of generated parameters alive after eviction
+                self.weights_cache[key] = (w.clone(), b.clone())
+
+        weights, biases = [], []
+        for key in keys:
+            w, b = self.weights_cache[key]
+            self.weights_cache.move_to_end(key)
+            weights.append(w)
+            biases.append(b)
+        while len(self.weights_cache) > self.weights_cache_size:
+            self.weights_cache.popitem(last=False)
+        return torch.stack(weights), torch.stack(biases)
+
+    def dense_weights(self, weights):
+        # the generated weights as (batch, out, in) matrices
+        if self.rank is None:
+            return weights
+        u, v = self.split_factors(weights)
+        weights = torch.bmm(u, v)
+        if self.base_weights is not None:
+            weights = weights + self.base_weights
+        return weights
+
+    def split_factors(self, weights):
+        # splits the generated low rank weights to U - (batch, out, rank) and V - (batch, rank, in)
+        num_out, num_in = self.weights_shape2d
+        u = weights[:, :num_out * self.rank].reshape(-1, num_out, self.rank)
+        v = weights[:, num_out * self.rank:].reshape(-1, self.rank, num_in)
+        return u, v
+
+
+def enable_weights_cache(model, max_size=1024):
+    # enables the inference cache of generated parameters in all the hypernetworks of the model
+    for module in model.modules():
+        if isinstance(module, HyperNetwork):
+            module.enable_weights_cache(max_size)
+
+
+def weights_cache_info(model):
+    info = {}
+    for name, module in model.named_modules():
+        if isinstance(module, HyperNetwork) and module.weights_cache is not None:
+            info[name] = dict(hits=module.cache_hits, misses=module.cache_misses,
+                              size=len(module.weights_cache), max_size=module.weights_cache_size)
+    return info
+
+
+class HyperParameterBank(nn.Module):
+    """ opt-in fusion of the parameters generators of the hypernetworks of a model that are conditioned on the
+    same input. the nn.Linear generators (of the weights and of the biases) of a partition of the hypernetworks
+    are held in one persistent fused parameter and each generator's weight and bias are views into it, so the
+    generation runs at the start of the forward (see fused) without concatenating anything per call - one GEMM
+    per embedding model of the partition. the partitions are the hypernetworks of the deduplicating layers
+    (dedup=True, generated on the unique conditioning rows only) and the rest. a partition is fused when all its
+    embeddings have the same width - the hypernetworks that aren't fused (e.g. chunked or recomputed) generate
+    their parameters as usual """
+    def __init__(self, model):
+        super().__init__()
+        # {dedup: {id(embedding model): [(name, hyper net)]}}
+        candidates = {False: OrderedDict(), True: OrderedDict()}
+        seen = set()
+        for name, module in model.named_modules():
+            if not isinstance(module, (HyperLinearLayer, HyperConv3dLayer)):
+                continue
+            net = module.hyper_net
+            if type(net.weights_gen) is nn.Linear and not net.recompute and id(net) not in seen:
+                seen.add(id(net))
+                candidates[module.dedup].setdefault(id(net.embedding_model), []).append((f"{name}.hyper_net", net))
+
+        # the hypernetworks are referenced by name - DataParallel replicas resolve their own copies of them
+        self.partitions = []
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+        for unique, groups in candidates.items():
+            groups = list(groups.values())
+            widths = {group[0][1].parameters_generators_input_size for group in groups}
+            if len(widths) != 1:
+                continue
+            generators = [[gen for _, net in group for gen in (net.weights_gen, net.bias_gen)] for group in groups]
+            all_generators = [gen for group in generators for gen in group]
+            self.weights.append(nn.Parameter(torch.cat([gen.weight.detach() for gen in all_generators])))
+            self.biases.append(nn.Parameter(torch.cat([gen.bias.detach() for gen in all_generators])))
+            self.partitions.append(dict(
+                unique=unique, names=[name for group in groups for name, _ in group],
+                embedding_idxs=list(np.cumsum([0] + [len(group) for group in groups[:-1]])),  # first net per group
+                group_rows=[sum(gen.out_features for gen in group) for group in generators],
+                group_sizes=[[gen.out_features for gen in group] for group in generators],
+                sizes=[gen.out_features for gen in all_generators]))
+        self.tie(model)
+
+    def fused_shape(self):
+        # [(generators input size - all the embeddings, generators output size - all the weights and biases)]
+        return [(len(partition["group_rows"]) * weight.shape[1], weight.shape[0])
+                for partition, weight in zip(self.partitions, self.weights)]
+
+    def extra_repr(self):
+        return f"hyper_nets={sum(len(partition['names']) for partition in self.partitions)}, " \
+               f"fused_shape={self.fused_shape()}"
+
+    @staticmethod
+    def resolve(model, partition):
+        # the hypernetworks of the partition in the model - None if one of them was replaced (e.g. by quantization)
+        nets = []
+        for name in partition["names"]:
+            try:
+                net = model.get_submodule(name)
+            except AttributeError:
+                return None
+            if not isinstance(net, HyperNetwork) or type(net.weights_gen) is not nn.Linear:
+                return None
+            nets.append(net)
+        return nets
+
+    @torch.no_grad()
+    def tie(self, model):
+        for idx, partition in enumerate(self.partitions):
+            nets = self.resolve(model, partition)
+            if nets is not None:
+                self.tie_partition(idx, nets)
+
+    @torch.no_grad()
+    def tie_partition(self, idx, nets):
+        # makes the generators' parameters views of the fused ones. moving or casting the model (.to, .cuda)
+        # replaces the data of every parameter on its own - the fused parameters are then rebuilt from the
+        # generators' (they are what the checkpoints of the layers hold)
+        generators = [gen for net in nets for gen in (net.weights_gen, net.bias_gen)]
+        sizes = self.partitions[idx]["sizes"]
+        weight, bias = self.weights[idx], self.biases[idx]
+        views = zip(weight.data.split(sizes), bias.data.split(sizes))
+        if all(gen.weight.data_ptr() == w.data_ptr() and gen.bias.data_ptr() == b.data_ptr()
+               for gen, (w, b) in zip(generators, views)):
+            return
+        weight.data = torch.cat([gen.weight.data for gen in generators])
+        bias.data = torch.cat([gen.bias.data for gen in generators])
+        for gen, w, b in zip(generators, weight.data.split(sizes), bias.data.split(sizes)):
+            gen.weight.data = w
+            gen.bias.data = b
+
+    @staticmethod
+    def embed(x, nets):
+        # the concatenated embeddings of x by the embedding models of the given hypernetworks
+        embedding_models = [net.embedding_model for net in nets]
+        if all(type(model) is nn.Linear for model in embedding_models):
+            # linear embeddings of the same input are fused to one GEMM as well
+            return F.linear(x.float(), torch.cat([model.weight for model in embedding_models]),
+                            torch.cat([model.bias for model in embedding_models]))
+        return torch.cat([net.embed(x) for net in nets], dim=1)
+
+    def generate(self, model, x):
+        banked = {}
+        for idx, partition in enumerate(self.partitions):
+            nets = self.resolve(model, partition)
+            if nets is None or any(net.weights_cache_active() for net in nets):
+                continue
+            if not getattr(self, "_is_replica", False):  # the replicas' parameters are broadcast separately
+                self.tie_partition(idx, nets)
+            weight, bias = self.weights[idx], self.biases[idx]
+
+            with full_precision(x):
+                emb = self.embed(x, [nets[i] for i in partition["embedding_idxs"]])
+                rows_groups = None
+                if partition["unique"]:
+                    # the embedding runs on the whole batch (as in forward_unique), the generators on unique rows
+                    first_idxs, rows_groups = unique_rows(x)
+                    emb = emb[first_idxs]
+                # one GEMM per embedding (a single one when they share it) over views of the fused parameters,
+                # and the outputs are split to views per generator - nothing is concatenated
+                out = []
+                groups = zip(emb.split(weight.shape[1], dim=1), weight.split(partition["group_rows"]),
+                             bias.split(partition["group_rows"]))
+                for group_emb, group_weight, group_bias in groups:
+                    out.append(F.linear(group_emb, group_weight, group_bias))
+                out = [gen_out for group_out, sizes in zip(out, partition["group_sizes"])
+                       for gen_out in group_out.split(sizes, dim=1)]
+
+            banked.update({id(net): (x, out[2 * i], out[2 * i + 1], rows_groups) for i, net in enumerate(nets)})
+        return banked
+
+    @contextmanager
+    def fused(self, model, x):
+        """ generates the parameters of all the fused hypernetworks of model conditioned on x at once, hyper
+        layers called with the same x tensor within this context use them """
+        outer = getattr(_forward_scope, "banked", None)
+        _forward_scope.banked = dict(outer or {})
+        _forward_scope.banked.update(self.generate(model, x))
+        try:
+            yield
+        finally:
+            _forward_scope.banked = outer
+
+
+HYPER_ENGINES = ("auto", "batched", "loop", "matmul")
+
+
+def forward_recompute(layer, x, features, unique=False):
+    # only the embedding is kept for the backward: the parameters generation and their application to x are
+    # checkpointed, so the (batch x num_weights) generated parameters are regenerated in the backward
+    hyper_net = layer.hyper_net
+    emb_out = hyper_net.embed(features)
+    groups = None
+    if unique:
+        first_idxs, groups = unique_rows(features)
+        emb_out = emb_out[first_idxs]
+
+    def generate_and_apply(x, emb_out):
+        weights, biases = hyper_net.generate(emb_out)
+        if groups is not None:
+            return layer.apply_unique(x, weights, biases, groups)
+        return layer.apply_parameters(x, weights, biases)
+
+    num_generated = hyper_net.weights_gen.out_features + hyper_net.bias_gen.out_features
+    hyper_net.recompute_saved_bytes = emb_out.shape[0] * num_generated * x.element_size()
+    return checkpoint(generate_and_apply, x, emb_out, use_reentrant=False)
+
+
+def recompute_memory_report(model):
+    # bytes of generated parameters that the last training forward didn't keep for the backward, per layer
+    report = {name: module.recompute_saved_bytes for name, module in model.named_modules()
+              if isinstance(module, HyperNetwork) and module.recompute}
+    report["total"] = sum(report.values())
+    return report
+
+
+def conv3d_patches(x, kernel_size, stride, padding):
+    # im2col for 3d inputs (there is no 3d unfold): (batch, in * k^3, output voxels) columns ordered like the
+    # flattened (in, k, k, k) conv kernels, gathered with k^3 strided slices of the padded input
+    x = F.pad(x, [padding] * 6)
+    spatial_shape = [(size - kernel_size) // stride + 1 for size in x.shape[2:]]
+    patches = [x[:, :, d:d + stride * (spatial_shape[0] - 1) + 1:stride,
+                 h:h + stride * (spatial_shape[1] - 1) + 1:stride,
+                 w:w + stride * (spatial_shape[2] - 1) + 1:stride]
+               for d, h, w in itertools.product(range(kernel_size), repeat=3)]
+    cols = torch.stack(patches, dim=2)  # (batch, in, k^3, *output spatial shape)
+    return cols.flatten(1, 2).flatten(2), spatial_shape
+
+
+def unique_rows(x):
+    # returns the index of the first occurrence of each unique row of x and the group (unique row) of every row
+    _, groups = torch.unique(x, dim=0, return_inverse=True)
+    rows = torch.arange(x.shape[0], device=x.device)
+    first_idxs = torch.full((int(groups.max()) + 1,), x.shape[0], dtype=rows.dtype, device=x.device)
+    first_idxs = first_idxs.scatter_reduce(0, groups, rows, reduce="amin")
+    return first_idxs, groups
+
+
+def apply_per_group(x, groups, weights, biases, dense_op):
+    # runs dense_op once per group of samples that share the same generated weights
+    order = torch.argsort(groups, stable=True)
+    group_sizes = torch.bincount(groups, minlength=weights.shape[0]).tolist()
+    out = [dense_op(x_group, w, b) for x_group, w, b in zip(x[order].split(group_sizes), weights, biases)]
+    return torch.cat(out)[torch.argsort(order)]
+
 
 class HyperLinearLayer(nn.Module):
     def __init__(self, in_features, out_features, embedding_model, embedding_output_size,
-                 weights_init_method=None, train_loader=None, hyper_input_type=None, GPU=None, var_hypernet_input=None):
+                 weights_init_method=None, train_loader=None, hyper_input_type=None, GPU=None, var_hypernet_input=None,
+                 engine="batched", rank=None, low_rank_mode="factorized",
+                 chunk_size=None, chunk_embedding_size=8, dedup=False,
+                 variance_subsample=None, recompute=False):
         super().__init__()
         num_weights = in_features * out_features
         num_biases = out_features
-        self.hyper_net = HyperNetwork(embedding_model, embedding_output_size, num_weights, num_biases)
+        self.hyper_net = HyperNetwork(embedding_model, embedding_output_size, num_weights, num_biases,
+                                      rank=rank, weights_shape2d=(out_features, in_features),
+                                      low_rank_mode=low_rank_mode, chunk_size=chunk_size,
+                                      chunk_embedding_size=chunk_embedding_size)
 
         self.num_out_features = out_features
         self.weights_shape = (out_features, in_features)
 
+        # "batched" ("auto", "matmul") applies all the generated weights with one batched matmul,
+        # "loop" is the per-sample reference implementation
+        assert engine in HYPER_ENGINES, f"engine must be one of {HYPER_ENGINES}, got '{engine}'"
+        self.engine = engine
+        # generate the weights once per unique conditioning row and run a dense op per group of samples
+        self.dedup = dedup
+        # don't keep the generated weights for the backward - regenerate them there from the embedding
+        self.hyper_net.recompute = recompute
+
         # initialize the weights of the layer if there is weights_init_method value
         if not (weights_init_method is None):
             self.hyper_net.initialize_parameters(weights_init_method, in_features, hyper_input_type,
                                                  for_conv=False, train_loader=train_loader, GPU=GPU,
-                                                 var_hypernet_input=var_hypernet_input)
+                                                 var_hypernet_input=var_hypernet_input,
+                                                 variance_subsample=variance_subsample)
 
     def forward(self, x):
         x, features = x[0], x[1]
 
+        if self.hyper_net.recompute and torch.is_grad_enabled():
+            return forward_recompute(self, x, features, unique=self.dedup and not is_tracing())
+
+        if self.dedup and not is_tracing():
+            weights, biases, groups = self.hyper_net.forward_unique(features)
+            return self.apply_unique(x, weights, biases, groups)
+
         weights, biases = self.hyper_net(features)  # creates #batch_size sets of parameters for the linear operation
+        return self.apply_parameters(x, weights, biases)
+
+    def apply_unique(self, x, weights, biases, groups):
+        weights = self.hyper_net.dense_weights(weights).view(-1, *self.weights_shape)
+        return apply_per_group(x, groups, weights, biases, lambda x_group, w, b: F.linear(x_group, w, b))
+
+    def apply_parameters(self, x, weights, biases):
+        if self.hyper_net.rank is not None:
+            return self.forward_low_rank(x, weights, biases)
+        if self.engine == "loop":
+            return self.forward_loop(x, weights, biases)
+
+        # each input of the batch has different weights: out[i] = W[i] @ x[i] + b[i] for all i at once
+        weights = weights.view(-1, *self.weights_shape)
+        out = torch.baddbmm(biases.unsqueeze(-1), weights, x.unsqueeze(-1))
+        return out.squeeze(-1)
+
+    def forward_low_rank(self, x, weights, biases):
+        # out[i] = U[i] (V[i] x[i]) + b[i] as two thin batched matmuls, without materializing U[i] V[i]
+        u, v = self.hyper_net.split_factors(weights)
+        out = torch.bmm(v, x.unsqueeze(-1))
+        out = torch.baddbmm(biases.unsqueeze(-1), u, out).squeeze(-1)
+        if self.hyper_net.base_weights is not None:
+            out = out + F.linear(x, self.hyper_net.base_weights)
+        return out
+
+    def forward_loop(self, x, weights, biases):
         out = torch.zeros((x.shape[0], self.num_out_features), dtype=x.dtype, layout=x.layout, device=x.device)
         for i, (w, b) in enumerate(zip(weights, biases)):
             # each input of the batch has different weights for the feedforward
@@ -129,14 +704,19 @@ class HyperLinearLayer(nn.Module):
 class LinearLayer(nn.Module):
     def __init__(self, in_features, out_features, embedding_model=None, embedding_output_size=None,
                  weights_init_method=None, train_loader=None, hyper_input_type=None, GPU=None,
-                 var_hypernet_input=None):
+                 var_hypernet_input=None, engine="batched", rank=None, low_rank_mode="factorized",
+                 chunk_size=None, chunk_embedding_size=8, dedup=False,
+                 variance_subsample=None, recompute=False):
         super().__init__()
         self.hyper = not(embedding_model is None)  # if there is an embedding model that hyper is True
         if self.hyper:
             self.layer = HyperLinearLayer(in_features=in_features, out_features=out_features,
                                           embedding_model=embedding_model, embedding_output_size=embedding_output_size,
                                           weights_init_method=weights_init_method, train_loader=train_loader,
-                                          hyper_input_type=hyper_input_type, GPU=GPU, var_hypernet_input=var_hypernet_input)
+                                          hyper_input_type=hyper_input_type, GPU=GPU, var_hypernet_input=var_hypernet_input,
+                                          engine=engine, rank=rank, low_rank_mode=low_rank_mode,
+                                          chunk_size=chunk_size, chunk_embedding_size=chunk_embedding_size,
+                                          dedup=dedup, variance_subsample=variance_subsample, recompute=recompute)
         else:
             self.layer = nn.Linear(in_features=in_features, out_features=out_features)
 
@@ -149,51 +729,147 @@ class LinearLayer(nn.Module):
 class HyperConv3dLayer(nn.Module):
     def __init__(self, in_channels, out_channels, kernel_size, embedding_model, embedding_output_size,
                  weights_init_method=None, train_loader=None, hyper_input_type=None, GPU=None, var_hypernet_input=None,
-                 stride=1, padding=1):
+                 stride=1, padding=1, engine="auto", rank=None, low_rank_mode="factorized",
+                 chunk_size=None, chunk_embedding_size=8, dedup=False,
+                 variance_subsample=None, recompute=False):
         super().__init__()
         num_weights = in_channels * out_channels * (kernel_size ** 3)  # num of weights and biases
         num_biases = out_channels
         self.stride = stride
         self.padding = padding
 
-        self.hyper_net = HyperNetwork(embedding_model, embedding_output_size, num_weights, num_biases)
+        self.hyper_net = HyperNetwork(embedding_model, embedding_output_size, num_weights, num_biases,
+                                      rank=rank, weights_shape2d=(out_channels, in_channels * (kernel_size ** 3)),
+                                      low_rank_mode=low_rank_mode, chunk_size=chunk_size,
+                                      chunk_embedding_size=chunk_embedding_size)
 
         self.num_out_channels = out_channels
         self.weights_shape = (out_channels, in_channels, kernel_size, kernel_size, kernel_size)
 
+        # "batched" runs one grouped convolution for the whole batch, "loop" one convolution per sample
+        # and "auto" measures both once per input shape and keeps the faster one. "matmul" is an im2col +
+        # batched matmul convolution without batch size dependent groups - for exported (onnx), traced and
+        # compiled graphs, which "auto" uses as well
+        assert engine in HYPER_ENGINES, f"engine must be one of {HYPER_ENGINES}, got '{engine}'"
+        self.engine = engine
+        self.auto_engine_choices = {}  # (device, input shape) -> measured engine
+        # generate the weights once per unique conditioning row and run a dense op per group of samples
+        self.dedup = dedup
+        # don't keep the generated weights for the backward - regenerate them there from the embedding
+        self.hyper_net.recompute = recompute
+
         # initialize the weights of the layer if there is weights_init_method value
         if not (weights_init_method is None):
             fan_in = in_channels * (kernel_size ** 3)
             self.hyper_net.initialize_parameters(weights_init_method, fan_in, hyper_input_type,
                                                  for_conv=True, train_loader=train_loader, GPU=GPU,
-                                                 var_hypernet_input=var_hypernet_input)
+                                                 var_hypernet_input=var_hypernet_input,
+                                                 variance_subsample=variance_subsample)
 
     def forward(self, x):
         x, features = x[0], x[1]
 
-        weights, biases = self.hyper_net(features)  # creates #batch_size sets of parameters for the linear operation
-
-        # first sample forward to determine the shape of the output
-        out0 = F.conv3d(input=x[0][None], weight=weights[0].reshape(self.weights_shape),
-                        bias=biases[0], stride=self.stride, padding=self.padding)
-
-        out = torch.zeros([x.shape[0]] + list(out0.shape[1:]), dtype=x.dtype, layout=x.layout, device=x.device)
-        out[0] = out0
-        if x.shape[0] > 1:  # if the batch is bigger than aize 1
-            for i, (w, b) in enumerate(zip(weights[1:], biases[1:])):
-                # each input of the batch has different weights for the feedforward
-                w = w.reshape(self.weights_shape)
-                out[i + 1] = F.conv3d(input=x[i][None], weight=w, bias=b, stride=self.stride,
-                                      padding=self.padding)
-
+        if self.hyper_net.recompute and torch.is_grad_enabled():
+            return forward_recompute(self, x, features, unique=self.dedup and not is_tracing())
+
+        if self.dedup and not is_tracing():
+            weights, biases, groups = self.hyper_net.forward_unique(features)
+            return self.apply_unique(x, weights, biases, groups)
+
+        weights, biases = self.hyper_net(features)  # creates #batch_size sets of parameters for the conv operation
+        return self.apply_parameters(x, weights, biases)
+
+    def apply_unique(self, x, weights, biases, groups):
+        weights = self.hyper_net.dense_weights(weights).view(-1, *self.weights_shape)
+        return apply_per_group(x, groups, weights, biases, lambda x_group, w, b: F.conv3d(
+            x_group, w, b, stride=self.stride, padding=self.padding))
+
+    def apply_parameters(self, x, weights, biases):
+        if self.hyper_net.rank is not None:
+            return self.forward_low_rank(x, weights, biases)
+
+        engine = self.engine
+        if engine == "auto":
+            # a traced / compiled graph gets the matmul engine - the grouped convolution of "batched" would bake
+            # the batch size into it (groups=B), and the measurement can't run while tracing
+            engine = "matmul" if is_tracing() else self.measure_engine(x, weights, biases)
+
+        if engine == "loop":
+            return self.forward_loop(x, weights, biases)
+        if engine == "matmul":
+            return self.forward_matmul(x, weights, biases)
+        return self.forward_batched(x, weights, biases)
+
+    def forward_batched(self, x, weights, biases):
+        # fold the batch into the channels dimension and run a single grouped convolution - group i
+        # convolves the channels of sample i with the i-th generated kernels
+        batch_size = x.shape[0]
+        weights = weights.reshape(batch_size * self.weights_shape[0], *self.weights_shape[1:])
+        out = F.conv3d(input=x.reshape(1, -1, *x.shape[2:]), weight=weights, bias=biases.reshape(-1),
+                       stride=self.stride, padding=self.padding, groups=batch_size)
+        return out.view(batch_size, self.num_out_channels, *out.shape[2:])
+
+    def forward_matmul(self, x, weights, biases):
+        # out[i] = W[i] @ patches(x[i]) + b[i] for all i at once, with W[i] as an (out, in * k^3) matrix
+        cols, spatial_shape = conv3d_patches(x, self.weights_shape[2], self.stride, self.padding)
+        out = torch.baddbmm(biases.unsqueeze(-1), weights.view(-1, self.num_out_channels, cols.shape[1]), cols)
+        return out.view(-1, self.num_out_channels, *spatial_shape)
+
+    def forward_low_rank(self, x, weights, biases):
+        # the rows of V are rank kernels of shape (in, k, k, k) - convolve with them (grouped per sample)
+        # and then mix their rank output channels with U, instead of convolving with U V
+        batch_size = x.shape[0]
+        u, v = self.hyper_net.split_factors(weights)
+        if self.engine == "matmul" or (self.engine == "auto" and is_tracing()):
+            out, spatial_shape = conv3d_patches(x, self.weights_shape[2], self.stride, self.padding)
+            out = torch.bmm(v, out)
+        else:
+            v = v.reshape(batch_size * self.hyper_net.rank, *self.weights_shape[1:])
+            out = F.conv3d(input=x.reshape(1, -1, *x.shape[2:]), weight=v,
+                           stride=self.stride, padding=self.padding, groups=batch_size)
+            spatial_shape = out.shape[2:]
+            out = out.reshape(batch_size, self.hyper_net.rank, -1)
+        out = torch.baddbmm(biases.unsqueeze(-1), u, out)
+        out = out.view(-1, self.num_out_channels, *spatial_shape)
+        if self.hyper_net.base_weights is not None:
+            out = out + F.conv3d(input=x, weight=self.hyper_net.base_weights.view(self.weights_shape),
+                                 stride=self.stride, padding=self.padding)
         return out
 
+    def forward_loop(self, x, weights, biases):
+        out = []
+        for i, (w, b) in enumerate(zip(weights, biases)):
+            # each input of the batch has different weights for the feedforward
+            w = w.reshape(self.weights_shape)
+            out.append(F.conv3d(input=x[i][None], weight=w, bias=b, stride=self.stride, padding=self.padding))
+        return torch.cat(out)
+
+    def measure_engine(self, x, weights, biases, repeats=3):
+        key = (x.device.type, tuple(x.shape))
+        if key not in self.auto_engine_choices:
+            timings = {}
+            with torch.no_grad():
+                for engine, engine_forward in (("batched", self.forward_batched), ("loop", self.forward_loop)):
+                    engine_forward(x, weights, biases)  # warmup
+                    if x.is_cuda:
+                        torch.cuda.synchronize(x.device)
+                    start = time.perf_counter()
+                    for _ in range(repeats):
+                        engine_forward(x, weights, biases)
+                    if x.is_cuda:
+                        torch.cuda.synchronize(x.device)
+                    timings[engine] = time.perf_counter() - start
+            self.auto_engine_choices[key] = min(timings, key=timings.get)
+        return self.auto_engine_choices[key]
+
 
 class Conv3DLayer(nn.Module):
     def __init__(self,  in_channels, out_channels, kernel_size=3, stride=1, padding=1,
                  embedding_model=None, embedding_output_size=None,
                  weights_init_method=None, train_loader=None, hyper_input_type=None, GPU=None,
-                 var_hypernet_input=None):
+                 var_hypernet_input=None, engine="auto", rank=None, low_rank_mode="factorized",
+                 chunk_size=None, chunk_embedding_size=8, dedup=False,
+                 variance_subsample=None, recompute=False):
         super().__init__()
         self.hyper = not(embedding_model is None)  # if there is an embedding model that hyper is True
         if self.hyper:
@@ -201,7 +877,10 @@ class Conv3DLayer(nn.Module):
                                           kernel_size=kernel_size, stride=stride, padding=padding,
                                           embedding_model=embedding_model, embedding_output_size=embedding_output_size,
                                           weights_init_method=weights_init_method, train_loader=train_loader,
-                                          hyper_input_type=hyper_input_type, GPU=GPU, var_hypernet_input=var_hypernet_input)
+                                          hyper_input_type=hyper_input_type, GPU=GPU, var_hypernet_input=var_hypernet_input,
+                                          engine=engine, rank=rank, low_rank_mode=low_rank_mode,
+                                          chunk_size=chunk_size, chunk_embedding_size=chunk_embedding_size,
+                                          dedup=dedup, variance_subsample=variance_subsample, recompute=recompute)
 
         else:
             self.layer = nn.Conv3d(in_channels, out_channels, kernel_size=kernel_size, stride=stride, padding=padding)
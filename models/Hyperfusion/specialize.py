@@ -0,0 +1,106 @@
+import copy
+import torch
+import torch.nn as nn
+from models.Hyperfusion.hyper_base import HyperConv3dLayer, LinearLayer, Conv3DLayer, unique_rows
+
+
+def static_layer(hyper_layer, condition):
+    # a plain nn.Linear / nn.Conv3d holding the parameters the hyper layer generates for the condition (1, F)
+    hyper_net = hyper_layer.hyper_net
+    weights, biases = hyper_net(condition)
+    weights = hyper_net.dense_weights(weights).view(hyper_layer.weights_shape)
+
+    if isinstance(hyper_layer, HyperConv3dLayer):
+        out_channels, in_channels, kernel_size = weights.shape[:3]
+        layer = nn.Conv3d(in_channels, out_channels, kernel_size=kernel_size,
+                          stride=hyper_layer.stride, padding=hyper_layer.padding)
+    else:
+        out_features, in_features = weights.shape
+        layer = nn.Linear(in_features=in_features, out_features=out_features)
+    layer.weight.data.copy_(weights)
+    layer.bias.data.copy_(biases[0])
+    return layer.to(weights.device)
+
+
+def specialize(model, condition):
+    """ returns a copy of the (eval mode) model in which every hyper layer is replaced by a plain
+    nn.Linear / nn.Conv3d holding the parameters generated for the given conditioning vector """
+    condition = torch.as_tensor(condition, dtype=torch.float32, device=next(model.parameters()).device)
+    condition = condition.view(1, -1)
+
+    was_training = model.training
+    model.eval()
+    specialized = copy.deepcopy(model)
+    with torch.no_grad():
+        for module in specialized.modules():
+            if isinstance(module, (LinearLayer, Conv3DLayer)) and module.hyper:
+                # the plain layers of LinearLayer / Conv3DLayer ignore the tabular features
+                module.layer = static_layer(module.layer, condition)
+                module.hyper = False
+    model.train(was_training)
+
+    if hasattr(specialized, "hyper_bank"):
+        del specialized.hyper_bank  # nothing left to generate
+    return specialized
+
+
+def unique_conditions(conditions, max_conditions=None):
+    # the distinct conditioning (tabular) rows of a dataset, e.g. the genders array of BrainAge_Dataset
+    conditions = torch.as_tensor(conditions, dtype=torch.float32)
+    first_idxs, _ = unique_rows(conditions)
+    conditions = conditions[first_idxs]
+    if max_conditions is not None:
+        assert len(conditions) <= max_conditions, \
+            f"{len(conditions)} distinct conditions, more than max_conditions={max_conditions}"
+    return conditions
+
+
+class SpecializedModel(nn.Module):
+    """ one specialized copy of the model per conditioning vector. each sample of a batch is routed to the
+    copy of its conditioning row, so the forward runs without any hypernetwork """
+    def __init__(self, model, conditions):
+        super().__init__()
+        conditions = torch.as_tensor(conditions, dtype=torch.float32)
+        self.register_buffer("conditions", conditions.view(len(conditions), -1))
+        self.models = nn.ModuleList([specialize(model, condition) for condition in self.conditions])
+        self.eval()
+
+    def route(self, tabular):
+        # the index of the specialized copy for each row of the batch
+        matches = (tabular[:, None, :] == self.conditions[None]).all(dim=2)
+        known = matches.any(dim=1)
+        if not known.all():
+            raise ValueError(f"no specialized model for the conditioning rows {tabular[~known].tolist()}")
+        return matches.int().argmax(dim=1)
+
+    def forward(self, x):
+        image, tabular = x
+        model_idxs = self.route(tabular)
+        out = None
+        for idx in model_idxs.unique().tolist():
+            mask = model_idxs == idx
+            model_out = self.models[idx]((image[mask], tabular[mask]))
+            if out is None:
+                out = model_out.new_empty((len(image),) + model_out.shape[1:])
+            out[mask] = model_out
+        return out
+
+
+def check_equivalence(model, specialized_model, batches, atol=1e-4, rtol=1e-4):
+    # runs the original and the specialized model (both in eval mode) on (imgs, tabular, ...) batches and
+    # returns the max absolute / relative output differences, asserting they are within tolerance
+    was_training = model.training
+    model.eval()
+    max_abs_err = max_rel_err = 0.0
+    with torch.no_grad():
+        for batch in batches:
+            imgs, tabular = batch[0], batch[1]
+            expected = model((imgs, tabular))
+            out = specialized_model((imgs, tabular))
+            abs_err = (out - expected).abs()
+            max_abs_err = max(max_abs_err, abs_err.max().item())
+            max_rel_err = max(max_rel_err, (abs_err / expected.abs().clamp_min(1e-12)).max().item())
+            assert torch.allclose(out, expected, atol=atol, rtol=rtol), \
+                f"the specialized model deviates from the original model (max abs error {max_abs_err:.3g})"
+    model.train(was_training)
+    return dict(max_abs_err=max_abs_err, max_rel_err=max_rel_err)
@@ -6,6 +6,12 @@ from utils.utils import nonsquared_conf_mat
 from easydict import EasyDict
 
 
+def compile_forward(model):
+    # only the forward is compiled, so the model isn't wrapped and its state dict keys stay as they are
+    assert hasattr(torch, "compile"), "--compile needs torch>=2.0"
+    return torch.compile(model.forward)
+
+
 class PlModelWrapBrainAge(pl.LightningModule):
     def __init__(self, **wrapper_kwargs):
         super().__init__()
@@ -15,10 +21,13 @@ class PlModelWrapBrainAge(pl.LightningModule):
         self.batch_size = wrapper_kwargs.batch_size
         self.lr = wrapper_kwargs.optimizer.lr
         self.weight_decay = wrapper_kwargs.optimizer.weight_decay
+        self.compiled_forward = compile_forward(self.model) if wrapper_kwargs.get("compile", False) else None
 
         self.best_val_MAE = 1000
 
     def forward(self, x):
+        if self.compiled_forward is not None:
+            return self.compiled_forward(x)
         return self.model(x)
 
     def training_step(self, batch, batch_idx):
@@ -113,10 +122,13 @@ class PlModelWrapADcls(pl.LightningModule):
         self.class_weights = wrapper_kwargs.loss.class_weights
         self.num_classes = len(wrapper_kwargs.loss.class_weights)
         self.class_names = wrapper_kwargs.class_names
+        self.compiled_forward = compile_forward(self.model) if wrapper_kwargs.get("compile", False) else None
 
         self.best_val_balanced_acc = -1
 
     def forward(self, x):
+        if self.compiled_forward is not None:
+            return self.compiled_forward(x)
         return self.model(x)
 
     def training_step(self, batch, batch_idx):
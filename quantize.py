@@ -0,0 +1,42 @@
+from train import *
+from pl_wrap import *
+from utils.quantization import quantize_model, quantization_report
+from itertools import islice
+
+
+def main(config: EasyDict, ckpt_path, calibration_batches=16, output_path=None):
+    # Create the data module:
+    data_module_name = config.data_module.pop("data_module_name")
+    data_module = globals()[data_module_name](config.data_module)
+
+    wrapper = globals()[config.lightning_wrapper.wrapper_name]
+    model = wrapper.load_from_checkpoint(ckpt_path, map_location="cpu").model.cpu().eval()
+
+    # calibrate the activation ranges on a sample of the training set
+    int8_model = quantize_model(model, islice(data_module.train_dataloader(), calibration_batches))
+
+    num_classes = data_module.train_ds.num_classes if config.task == "AD_classification" else None
+    report = quantization_report(model, int8_model, data_module.val_dataloader(), config.task, num_classes)
+    print(f"fp32: {report['fp32']}\nint8: {report['int8']}\ndelta (int8 - fp32): {report['delta']}")
+
+    output_path = output_path or os.path.join(os.path.dirname(ckpt_path), "model_int8.pt")
+    torch.save(int8_model, output_path)
+    print(f"saved the int8 model to {output_path}")
+
+
+if __name__ == '__main__':
+    default_cfg_path = os.path.join(os.getcwd(), "experiments", "AD_classification", "default_train_config.yml")
+
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config_path', default=default_cfg_path, type=str,
+                        help="path to the YAML config file of the experiment (for the data module and the wrapper)")
+    parser.add_argument('--ckpt_path', type=str, required=True, help="a best_val.ckpt of train.py")
+    parser.add_argument('--calibration_batches', type=int, default=16, help="training batches for the calibration")
+    parser.add_argument('-o', '--output_path', type=str, default=None, help="default: model_int8.pt next to the ckpt")
+    args = parser.parse_args()
+
+    assert os.path.exists(args.config_path), f"config file '{args.config_path}' does not exist!"
+    with open(args.config_path, 'r') as file:
+        config = EasyDict(yaml.safe_load(file))
+
+    main(config, args.ckpt_path, args.calibration_batches, args.output_path)
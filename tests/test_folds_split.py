@@ -0,0 +1,96 @@
+import os
+import json
+import types
+import hashlib
+import pytest
+import numpy as np
+from data_utils.MetadataPreprocess import create_metadata_csv
+from data_utils.ADNI_data_handler import ADNI_Dataset, stratified_folds
+
+CSV_PATH = os.path.join(os.path.dirname(__file__), "..", "Datasets", "ADNI_2023", "my_adnimerege.csv")
+
+LABELS_DICTS = {
+    2: {"CN": 0, 'AD': 1},
+    3: {"CN": 0, 'MCI': 1, "AD": 2, 'EMCI': 1, "LMCI": 1},
+    5: {"CN": 0, 'MCI': 1, "AD": 2, 'EMCI': 3, "LMCI": 4}
+}
+
+# (features set, num classes, split seed): (sha1 of the json of the 5 folds' row lists, the folds sizes), computed
+# with the original nested sex x label x age bin loops of get_folds_split on my_adnimerege.csv. every saved
+# checkpoint was trained on these folds - they must never change
+PINNED_FOLDS = {
+    (0, 2, 0): ("cdfdaf90428bdbaff385abce2f4b8b462a2bf7f3", [221, 221, 221, 221, 221]),
+    (0, 2, 1): ("5b6d6f6993ae454af0b11be4cc876c566cc5b2ef", [221, 221, 221, 221, 221]),
+    (0, 2, 42): ("bfa72d39811389f761da53555c7eb9beb83c9df1", [221, 221, 221, 221, 221]),
+    (0, 3, 0): ("6892bf85eed9cea77e7bc284a95a75dc1977354e", [424, 424, 424, 424, 424]),
+    (0, 3, 1): ("834e7f920101a45a8ebac64397a05930425bf84e", [424, 424, 424, 424, 424]),
+    (0, 3, 42): ("b099c442688700b5a6b601fe55e151cba6bfcbeb", [424, 424, 424, 424, 424]),
+    (0, 5, 0): ("b87aec1b413b82ea91fea54ae945825a8a6247f0", [424, 424, 424, 424, 424]),
+    (0, 5, 1): ("5a54292e37825220242c43df5d900224c194eb7c", [424, 424, 424, 424, 424]),
+    (0, 5, 42): ("414469adddf2142656f5296d02b3debb77ff37b6", [424, 424, 424, 424, 424]),
+    (5, 2, 0): ("86ff692804093e521303c64c9b1bac6fe9daac7e", [221, 221, 221, 221, 221]),
+    (5, 2, 1): ("20083131304f3c27fbb5f28d3f1eb2db37008edc", [221, 221, 221, 221, 221]),
+    (5, 2, 42): ("3b5f505aae5229602aeaea974cc1e902d7411a79", [221, 221, 221, 221, 221]),
+    (5, 3, 0): ("9d430b70db06386695a2e4dca70c475f872b914b", [424, 424, 424, 424, 424]),
+    (5, 3, 1): ("0430e56107184c9f6c3c21ca0eb9b3b59817fe7d", [424, 424, 424, 424, 424]),
+    (5, 3, 42): ("0d6f5bbd2d7834c96efa64f52128f5b3b08d10e1", [424, 424, 424, 424, 424]),
+    (5, 5, 0): ("752bade79cb185bc364f4739dd75abae1ecea6f4", [424, 424, 424, 424, 424]),
+    (5, 5, 1): ("c5bd59d19258e148edd76141e863ca7599e0ce70", [424, 424, 424, 424, 424]),
+    (5, 5, 42): ("d57ec0b9ea2b2366fc69d68b77f9b9c3aafe7e8b", [424, 424, 424, 424, 424]),
+    (9, 3, 0): ("6892bf85eed9cea77e7bc284a95a75dc1977354e", [424, 424, 424, 424, 424]),
+    (9, 5, 1): ("5a54292e37825220242c43df5d900224c194eb7c", [424, 424, 424, 424, 424]),
+    (16, 2, 0): ("d6684dfdf9e00a2aa15939de11e3bcdf972db3c6", [221, 221, 221, 221, 221]),
+    (16, 2, 1): ("44bb076faa9799dc04dfb8f4074cc5198d28b790", [221, 221, 221, 221, 221]),
+    (16, 2, 42): ("10a82ae7d84ea58e23e376070a76790cfbb53306", [221, 221, 221, 221, 221]),
+    (16, 3, 0): ("c1d7fbfbcd91237241e193357193621c2526f98e", [424, 424, 424, 424, 424]),
+    (16, 3, 1): ("e9bf6a6d40d92616329ae5d2fd80ff5af3b8313d", [424, 424, 424, 424, 424]),
+    (16, 3, 42): ("50fc63dbf8a32a2850585aca3905cf8ee8acf171", [424, 424, 424, 424, 424]),
+    (16, 5, 0): ("4a09426a2d2e5366e0e016cfb4c21a5d26fc40b5", [424, 424, 424, 424, 424]),
+    (16, 5, 1): ("91e4fd63af238f4d5805c27757192416659df6fd", [424, 424, 424, 424, 424]),
+    (16, 5, 42): ("5cc1acf31eeef26508a50d6e81c763a125caf9d8", [424, 424, 424, 424, 424]),
+}
+
+_metadata = {}
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(tmp_path, monkeypatch):
+    # the folds manifests (and any other cache entry) are written to a temporary cache dir
+    monkeypatch.setattr("utils.cache_utils.CACHE_DIR", str(tmp_path))
+
+
+def split_metadata(features_set, num_classes):
+    # the metadata as ADNI_Dataset splits it (2 classes keep only AD and CN)
+    if features_set not in _metadata:
+        _metadata[features_set] = create_metadata_csv(features_set, csv_path=CSV_PATH)
+    metadata = _metadata[features_set]
+    if num_classes == 2:
+        metadata = metadata[(metadata["Group"] == "CN") | (metadata["Group"] == "AD")].reset_index(drop=True)
+    return metadata
+
+
+def folds_digest(folds):
+    folds = [[int(row) for row in fold] for fold in folds]
+    return hashlib.sha1(json.dumps(folds).encode()).hexdigest(), [len(fold) for fold in folds]
+
+
+@pytest.mark.parametrize("features_set, num_classes, split_seed", sorted(PINNED_FOLDS))
+def test_stratified_folds_pinned(features_set, num_classes, split_seed):
+    rows, folds = stratified_folds(split_metadata(features_set, num_classes), LABELS_DICTS[num_classes], split_seed)
+    digest = folds_digest([rows[folds == fold] for fold in range(5)])
+    assert digest == PINNED_FOLDS[(features_set, num_classes, split_seed)]
+
+
+@pytest.mark.parametrize("features_set, num_classes, split_seed", [(0, 3, 0), (16, 2, 42)])
+def test_get_folds_split_manifest(features_set, num_classes, split_seed, tmp_path):
+    # the first call writes the folds manifest and the second one reads it - both give the pinned folds
+    dataset = types.SimpleNamespace(metadata=split_metadata(features_set, num_classes), features_set=features_set,
+                                    num_classes=num_classes, labels_dict=LABELS_DICTS[num_classes])
+    for _ in range(2):
+        idxs = [ADNI_Dataset.get_folds_split(dataset, fold, split_seed) for fold in range(4)]
+        digest = folds_digest([split["valid"] for split in idxs] + [idxs[0]["test"]])
+        assert digest == PINNED_FOLDS[(features_set, num_classes, split_seed)]
+        train = np.sort(idxs[0]["train"])
+        assert np.array_equal(np.sort(np.concatenate([train, idxs[0]["valid"], idxs[0]["test"]])),
+                              np.arange(len(dataset.metadata)))
+    assert len(os.listdir(tmp_path / "folds")) == 1
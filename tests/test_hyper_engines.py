@@ -0,0 +1,63 @@
+import copy
+import pytest
+import torch
+import torch.nn as nn
+from models.Hyperfusion.hyper_base import HyperLinearLayer, HyperConv3dLayer
+
+
+def run_engine(layer, engine, x, features):
+    # the output and the gradients (of the layer's parameters and of the input) of a copy of the layer
+    layer = copy.deepcopy(layer)
+    layer.engine = engine
+    x = x.clone().requires_grad_(True)
+    out = layer((x, features))
+    out.pow(2).sum().backward()
+    grads = {name: param.grad for name, param in layer.named_parameters()}
+    grads["input"] = x.grad
+    return out.detach(), grads
+
+
+def assert_engines_agree(layer, engines, x, features, atol=1e-5, rtol=1e-4):
+    reference_out, reference_grads = run_engine(layer, engines[0], x, features)
+    for engine in engines[1:]:
+        out, grads = run_engine(layer, engine, x, features)
+        assert torch.allclose(out, reference_out, atol=atol, rtol=rtol), f"'{engine}' output differs"
+        for name, grad in reference_grads.items():
+            assert torch.allclose(grads[name], grad, atol=atol, rtol=rtol), f"'{engine}' gradient of {name} differs"
+
+
+@pytest.mark.parametrize("batch_size", [1, 5])
+def test_linear_engines_agree(batch_size):
+    torch.manual_seed(0)
+    layer = HyperLinearLayer(12, 7, embedding_model=nn.Linear(3, 4), embedding_output_size=4)
+    x, features = torch.randn(batch_size, 12), torch.randn(batch_size, 3)
+    assert_engines_agree(layer, ["loop", "batched"], x, features)
+
+
+@pytest.mark.parametrize("kernel_size, stride, padding", [(3, 1, 1), (3, 2, 1), (1, 2, 0)])
+def test_conv_engines_agree(kernel_size, stride, padding):
+    torch.manual_seed(0)
+    layer = HyperConv3dLayer(2, 3, kernel_size, embedding_model=nn.Linear(3, 4), embedding_output_size=4,
+                             stride=stride, padding=padding)
+    x, features = torch.randn(3, 2, 6, 7, 5), torch.randn(3, 3)
+    assert_engines_agree(layer, ["loop", "batched", "matmul", "auto"], x, features)
+
+
+def test_conv_auto_engine_measures_once_per_shape():
+    torch.manual_seed(0)
+    layer = HyperConv3dLayer(2, 3, 3, embedding_model=nn.Linear(3, 4), embedding_output_size=4)
+    for batch_size in [2, 2, 4]:
+        layer((torch.randn(batch_size, 2, 5, 5, 5), torch.randn(batch_size, 3)))
+    assert set(layer.auto_engine_choices) == {("cpu", (2, 2, 5, 5, 5)), ("cpu", (4, 2, 5, 5, 5))}
+    assert set(layer.auto_engine_choices.values()) <= {"batched", "loop"}
+
+
+@pytest.mark.filterwarnings("ignore::torch.jit.TracerWarning")
+@pytest.mark.parametrize("rank", [None, 2])
+def test_conv_auto_engine_traces_batch_size_independent(rank):
+    torch.manual_seed(0)
+    layer = HyperConv3dLayer(2, 3, 3, embedding_model=nn.Linear(3, 4), embedding_output_size=4, rank=rank).eval()
+    traced = torch.jit.trace(layer, ((torch.randn(3, 2, 5, 6, 7), torch.randn(3, 3)),))
+    for batch_size in [1, 5]:
+        inputs = (torch.randn(batch_size, 2, 5, 6, 7), torch.randn(batch_size, 3))
+        assert torch.allclose(traced(inputs), layer(inputs), atol=1e-5)
@@ -0,0 +1,36 @@
+import pytest
+import torch
+import torch.nn as nn
+from models.Hyperfusion.hyper_base import HyperLinearLayer, HyperConv3dLayer
+
+pytest.importorskip("onnxruntime")  # pip install -r requirements-onnx.txt
+from export_onnx import export_onnx, check_parity
+
+IMAGE_SHAPE = (8, 9, 7)
+TABULAR_SIZE = 3
+
+
+class ToyHyperModel(nn.Module):
+    # a hyper convolution (full and low rank) and a hyper linear layer conditioned on the tabular features
+    def __init__(self):
+        super().__init__()
+        self.conv = HyperConv3dLayer(1, 4, 3, embedding_model=nn.Linear(TABULAR_SIZE, 4), embedding_output_size=4,
+                                     stride=2)
+        self.low_rank_conv = HyperConv3dLayer(4, 4, 3, embedding_model=nn.Linear(TABULAR_SIZE, 4),
+                                              embedding_output_size=4, rank=2)
+        self.fc = HyperLinearLayer(4, 2, embedding_model=nn.Linear(TABULAR_SIZE, 4), embedding_output_size=4)
+
+    def forward(self, x):
+        image, tabular = x
+        out = torch.relu(self.conv((image, tabular)))
+        out = torch.relu(self.low_rank_conv((out, tabular)))
+        return self.fc((out.mean(dim=(2, 3, 4)), tabular))
+
+
+def test_onnx_runtime_matches_eager(tmp_path):
+    torch.manual_seed(0)
+    model = ToyHyperModel()
+    onnx_path = export_onnx(model, str(tmp_path / "toy.onnx"), IMAGE_SHAPE, TABULAR_SIZE)
+    # batch sizes other than the exported one (2) run on the same graph
+    max_abs_err = check_parity(model, onnx_path, IMAGE_SHAPE, TABULAR_SIZE, batch_sizes=(1, 3, 5))
+    assert max_abs_err < 1e-4
@@ -47,16 +47,18 @@ def main(config: EasyDict):
     if config.checkpointing.enable:
         callbacks += [config.checkpointing.CheckpointCallback(**config.checkpointing.callback_kwargs)]
 
-    if len(config.trainer.gpu) > 1:
+    accelerator = config.trainer.get("accelerator", "gpu")
+    if accelerator == "gpu" and len(config.trainer.gpu) > 1:
         strategy = "dp"
     else:
         strategy = None
 
     # Create the trainer:
     trainer = pl.Trainer(
-        accelerator="gpu",
-        devices=config.trainer.gpu,
+        accelerator=accelerator,
+        devices=config.trainer.gpu if accelerator == "gpu" else 1,
         strategy=strategy,
+        precision=config.trainer.get("precision", 32),  # "bf16" - mixed precision, the hypernetworks stay fp32
         default_root_dir=config.checkpointing.ckpt_dir,
 
         logger=logger,
@@ -74,6 +76,16 @@ def main(config: EasyDict):
     if not config.checkpointing.continue_train_from_ckpt:
         trainer.fit(pl_model, datamodule=data_module)
 
+    if config.task == "AD_classification" and config.checkpointing.enable:
+        # the fitted tabular preprocessing next to the checkpoints - for preprocessing new patients at inference
+        preprocessor_path = os.path.join(config.checkpointing.ckpt_dir, config.experiment_name,
+                                         f"fold_{config.data_module.dataset_cfg.fold}", "metadata_preprocessor.pkl")
+        data_module.metadata_preprocessor.save(preprocessor_path)
+
+    if config.model.get("hyper_recompute"):
+        report = recompute_memory_report(model)
+        print(f"hyper weights not kept for the backward (bytes per training step): {report}")
+
 
 def arrange_config4task(config: EasyDict):
     if config.task == "AD_classification":
@@ -174,6 +186,7 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-c', '--config_path', default=default_cfg_path, type=str, help="path to YAML config file")
     parser.add_argument('-d', '--debug', action='store_true', default=False)
+    parser.add_argument('--compile', action='store_true', default=False, help="torch.compile the model's forward")
     args = parser.parse_args()
 
     assert os.path.exists(args.config_path), f"config file '{args.config_path}' does not exist!"
@@ -194,4 +207,5 @@ if __name__ == '__main__':
         config.wandb.enable = False
         config.data_module.dataset_cfg.load2ram = False
 
+    config.lightning_wrapper.compile = args.compile
     main(config)
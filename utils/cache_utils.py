@@ -0,0 +1,70 @@
+import os
+import json
+import hashlib
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+# root directory of all the on-disk caches (can be moved with the HYPERFUSION_CACHE_DIR environment variable)
+CACHE_DIR = os.environ.get("HYPERFUSION_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "hyperfusion"))
+
+
+def cache_path(*parts):
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+def hash_key(*args):
+    # a short stable hash of the repr of the args (or of raw bytes)
+    h = hashlib.sha1()
+    for arg in args:
+        h.update(arg if isinstance(arg, bytes) else repr(arg).encode())
+    return h.hexdigest()[:16]
+
+
+def hash_file(path, chunk_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()[:16]
+
+
+def atomic_write(path, write_fn):
+    # write_fn(tmp_path) writes the file, which is then renamed into place so readers never see a partial file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_", suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+@contextmanager
+def file_lock(path):
+    # an exclusive lock on path between processes (and concurrent jobs), held on a path + ".lock" file
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_json(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def save_json(path, obj):
+    def write(tmp_path):
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f, indent=2)
+    atomic_write(path, write)
@@ -0,0 +1,41 @@
+import numpy as np
+import onnxruntime as ort
+
+
+class OnnxRunner:
+    """ runs a model exported by export_onnx.py on the onnx runtime CPU provider - needs only numpy and
+    onnxruntime (no torch / lightning, see requirements-onnx.txt) """
+    def __init__(self, onnx_path, num_threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, image, tabular):
+        inputs = dict(image=np.ascontiguousarray(image, dtype=np.float32),
+                      tabular=np.ascontiguousarray(tabular, dtype=np.float32))
+        return self.session.run(None, inputs)[0]
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    import time
+
+    parser = ArgumentParser(description="latency of an exported model on random inputs")
+    parser.add_argument("onnx_path", type=str)
+    parser.add_argument("--image_shape", type=int, nargs=3, required=True, help="D H W of the input scans")
+    parser.add_argument("--tabular_size", type=int, required=True)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--num_threads", type=int, default=None)
+    args = parser.parse_args()
+
+    runner = OnnxRunner(args.onnx_path, num_threads=args.num_threads)
+    image = np.random.randn(args.batch_size, 1, *args.image_shape).astype(np.float32)
+    tabular = np.random.randn(args.batch_size, args.tabular_size).astype(np.float32)
+    runner(image, tabular)  # warmup
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        runner(image, tabular)
+    print(f"{1000 * (time.perf_counter() - start) / args.repeats:.2f} ms per batch of {args.batch_size}")
@@ -0,0 +1,68 @@
+import copy
+import time
+import torch
+import torch.nn as nn
+import torchmetrics
+from torch.ao.quantization import QuantWrapper, get_default_qconfig, prepare, convert, quantize_dynamic
+
+
+def wrap_convs(module, qconfig):
+    # every nn.Conv3d gets its own quant / dequant stubs: the convolutions run in int8 while the residual
+    # additions, the generated (hyper) convolutions and the rest of the model stay in float
+    for name, child in module.named_children():
+        if isinstance(child, nn.Conv3d):
+            wrapper = QuantWrapper(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            wrap_convs(child, qconfig)
+
+
+def quantize_model(model, calibration_batches, backend=None):
+    """ int8 post training quantization for CPU inference: static quantization of the 3d convolutions with
+    activation ranges calibrated on (imgs, tabular, ...) batches, and dynamic quantization of the linear
+    layers - which include the hypernetworks parameters generators (weights_gen / bias_gen) """
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+
+    model = copy.deepcopy(model).cpu().eval()
+    wrap_convs(model, get_default_qconfig(backend))
+    prepare(model, inplace=True)
+    with torch.no_grad():
+        for batch in calibration_batches:
+            model((batch[0].float(), batch[1].float()))
+    convert(model, inplace=True)
+    quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    if hasattr(model, "hyper_bank"):
+        del model.hyper_bank  # the fused generators need float nn.Linear generators - the quantized ones run as is
+    return model
+
+
+def evaluate(model, dataloader, task, num_classes=None):
+    # the validation metric of the task - balanced accuracy (AD classification) or MAE (brain age), and the
+    # mean latency per batch
+    model.eval()
+    y_hat, y, latency = [], [], 0.0
+    with torch.no_grad():
+        for imgs, tabular, labels in dataloader:
+            start = time.perf_counter()
+            y_hat.append(model((imgs.float(), tabular.float())))
+            latency += time.perf_counter() - start
+            y.append(labels)
+    y_hat, y = torch.cat(y_hat), torch.cat(y)
+    if task == "AD_classification":
+        metric = torchmetrics.functional.accuracy(y_hat, y, num_classes=num_classes, average='macro').item()
+        metric_name = "balanced_acc"
+    else:
+        metric = torchmetrics.functional.mean_absolute_error(y_hat, y).item()
+        metric_name = "MAE"
+    return {metric_name: metric, "latency_per_batch": latency / len(dataloader)}
+
+
+def quantization_report(fp32_model, int8_model, dataloader, task, num_classes=None):
+    fp32 = evaluate(fp32_model, dataloader, task, num_classes)
+    int8 = evaluate(int8_model, dataloader, task, num_classes)
+    report = {"fp32": fp32, "int8": int8}
+    report["delta"] = {key: int8[key] - fp32[key] for key in fp32}
+    return report